@@ -1,10 +1,20 @@
 import os
+import sys
+import re
+import cgi
+import json
+import time
+import hashlib
 import datetime
+from collections import OrderedDict
 from dateutil.tz import *
 
+import redis
 import elasticsearch
+import elasticsearch.helpers
 
 from localconfig import *
+from lucene_syntax import check_query_string
 
 
 # XXX: This mechanism does not define ordering of distiller classes in the
@@ -54,14 +64,314 @@ indices = elasticsearch.client.IndicesClient(es)
 
 class InvalidDocument(Exception): pass
 
-def add_to_index(document):
-	key = document['url']
-
-	doc_type = determine_doc_type(key)
-	if doc_type is None:
-		raise LookupError("We don't have a module that can handle that URL: {0}".format(url))
 
-	index_name = "umad_%s" % doc_type
+# Smykowski and the auditlog watcher enqueue URLs whenever anything is
+# touched, even if nothing changed, and writing an identical document back
+# to ES just churns segments and causes merges. So we remember a fingerprint
+# of every document we write, and skip the write if it hasn't changed,
+# noting when we last checked it instead.
+#
+# In case ES loses documents behind our back, eg. an index gets recreated,
+# a fingerprint is only trusted for FINGERPRINT_MAX_AGE seconds after the
+# document was written; after that, it gets written again regardless. Set it
+# to 0 to always write.
+#
+# For each doc_type D we keep:
+#   umad_fingerprints:D   HASH   url -> "fingerprint written_at"
+#   umad_last_checked:D   HASH   url -> time we last saw it unchanged
+#   umad_index_stats      HASH   written, skipped, D:written, D:skipped
+FINGERPRINT_MAX_AGE = int(os.environ.get('UMAD_FINGERPRINT_MAX_AGE', 86400))
+
+fingerprints_key = "umad_fingerprints:{0}".format
+last_checked_key = "umad_last_checked:{0}".format
+INDEX_STATS_KEY  = "umad_index_stats"
+
+
+def fingerprint(document):
+	"A stable hash of the document's content, ignoring our own metadata that changes every time"
+	content = dict( (k, v) for (k, v) in document.items() if k != 'last_indexed' )
+	# Blobs can be str in any old encoding, latin-1 will never choke on them.
+	# We only need this to be stable, not pretty.
+	serialised = json.dumps(content, sort_keys=True, default=unicode, encoding='latin-1')
+	return hashlib.sha1(serialised).hexdigest()
+
+
+class FingerprintCache(object):
+	"""Remembers what we last wrote for each URL. Entries are
+	(doc_type, url, fingerprint) tuples.
+
+	This is purely an optimisation, so if Redis is unavailable we fail
+	open and write everything."""
+
+	def __init__(self, conn, max_age=FINGERPRINT_MAX_AGE):
+		self.conn       = conn
+		self.max_age    = max_age
+		self.complained = False
+
+	def complain(self, e):
+		if not self.complained:
+			sys.stderr.write("Not skipping unchanged documents, couldn't talk to Redis: {0}\n".format(e))
+			self.complained = True
+
+	def unchanged(self, entries):
+		"Return a list of booleans, True for each entry that doesn't need writing"
+		if not entries or not self.max_age:
+			return [ False for entry in entries ]
+
+		now = time.time()
+		try:
+			pipeline = self.conn.pipeline(transaction=False)
+			for (doc_type, url, fp) in entries:
+				pipeline.hget(fingerprints_key(doc_type), url)
+			remembered = pipeline.execute()
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+			return [ False for entry in entries ]
+
+		results = []
+		for ((doc_type, url, fp), previous) in zip(entries, remembered):
+			if previous is None:
+				results.append(False)
+				continue
+			(previous_fp, written_at) = previous.split(' ', 1)
+			results.append(previous_fp == fp and now - float(written_at) < self.max_age)
+
+		skipped = [ entry for (entry, skip) in zip(entries, results) if skip ]
+		if skipped:
+			try:
+				pipeline = self.conn.pipeline(transaction=False)
+				for (doc_type, url, fp) in skipped:
+					pipeline.hset(last_checked_key(doc_type), url, now)
+					pipeline.hincrby(INDEX_STATS_KEY, '{0}:skipped'.format(doc_type), 1)
+				pipeline.hincrby(INDEX_STATS_KEY, 'skipped', len(skipped))
+				pipeline.execute()
+			except redis.exceptions.RedisError as e:
+				self.complain(e)
+
+		return results
+
+	def remember(self, entries):
+		"These entries have been written to ES"
+		if not entries:
+			return
+
+		now = time.time()
+		try:
+			pipeline = self.conn.pipeline(transaction=False)
+			for (doc_type, url, fp) in entries:
+				pipeline.hset(fingerprints_key(doc_type), url, "{0} {1}".format(fp, now))
+				pipeline.hset(last_checked_key(doc_type), url, now)
+				pipeline.hincrby(INDEX_STATS_KEY, '{0}:written'.format(doc_type), 1)
+			pipeline.hincrby(INDEX_STATS_KEY, 'written', len(entries))
+			pipeline.execute()
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+
+	def forget(self, doc_type, url):
+		"The document is gone from ES, so we'd better write it next time"
+		try:
+			pipeline = self.conn.pipeline(transaction=False)
+			pipeline.hdel(fingerprints_key(doc_type), url)
+			pipeline.hdel(last_checked_key(doc_type), url)
+			pipeline.execute()
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+
+	def forget_all(self, doc_type):
+		"""The whole index is gone, eg. it's being rebuilt, so write every
+		document next time. Unlike the rest of the cache this doesn't fail
+		open, skipping documents that aren't in ES would be worse than
+		useless."""
+		pipeline = self.conn.pipeline(transaction=False)
+		pipeline.delete(fingerprints_key(doc_type))
+		pipeline.delete(last_checked_key(doc_type))
+		pipeline.execute()
+
+	def stats(self):
+		"How many documents we've written and skipped, overall and for each doc_type"
+		return dict( (k, int(v)) for (k, v) in self.conn.hgetall(INDEX_STATS_KEY).items() )
+
+
+_fingerprint_cache = None
+
+def fingerprint_cache():
+	global _fingerprint_cache
+	if _fingerprint_cache is None:
+		redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
+		redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
+		_fingerprint_cache = FingerprintCache(redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0))
+	return _fingerprint_cache
+
+
+# Staff run the same handful of searches all day, so we keep the results.
+# Each web frontend process has a small LRU of its own, and they all share a
+# tier in Redis, so a search that's been done on one host is a hit on the
+# others.
+#
+# Every doc_type has a generation number, which is bumped whenever we write
+# to or delete from its index. Cached results remember the generations of
+# the indices they came from, and are ignored once any of those have moved
+# on. Entries also expire after SEARCH_CACHE_SECONDS regardless; set it to 0
+# to turn the cache off.
+#
+#   umad_generation:D         STRING  generation of doc_type D's index
+#   umad_search_cache:KEY     STRING  JSON {generations, expires, result}, KEY is a hash of the search
+SEARCH_CACHE_SECONDS = int(os.environ.get('UMAD_SEARCH_CACHE_SECONDS', 300))
+SEARCH_CACHE_SIZE    = int(os.environ.get('UMAD_SEARCH_CACHE_SIZE', 500))
+
+generation_key   = "umad_generation:{0}".format
+search_cache_key = "umad_search_cache:{0}".format
+
+
+class SearchCache(object):
+	"""Caches anything we ask ES about a search, keyed by what sort of
+	question it was, the normalised query, the hit count, the doc_types
+	involved, and any filters.
+
+	Like the FingerprintCache this is an optimisation, so if Redis is
+	unavailable we just go to ES every time."""
+
+	def __init__(self, conn, max_age=SEARCH_CACHE_SECONDS, size=SEARCH_CACHE_SIZE):
+		self.conn       = conn
+		self.max_age    = max_age
+		self.size       = size
+		self.local      = OrderedDict() # key -> entry, least recently used first
+		self.complained = False
+
+	def complain(self, e):
+		if not self.complained:
+			sys.stderr.write("Not caching searches, couldn't talk to Redis: {0}\n".format(e))
+			self.complained = True
+
+	@staticmethod
+	def key(kind, search_term, count, doc_types, filters=()):
+		# Case matters, "foo AND bar" isn't "foo and bar"
+		normalised = u' '.join(search_term.split())
+		search = json.dumps([ kind, normalised, count, sorted(doc_types), filters ], sort_keys=True)
+		return hashlib.sha1(search.encode('utf8')).hexdigest()
+
+	def cached(self, kind, search_term, count, doc_types, fn, filters=()):
+		"Return fn(), or what it returned last time if none of the doc_types' indices have changed since"
+		if not self.max_age:
+			return fn()
+
+		doc_types = sorted(doc_types)
+		key = self.key(kind, search_term, count, doc_types, filters)
+		try:
+			pipeline = self.conn.pipeline(transaction=False)
+			pipeline.mget([ generation_key(doc_type) for doc_type in doc_types ])
+			pipeline.get(search_cache_key(key))
+			(generations, shared) = pipeline.execute()
+		except redis.exceptions.RedisError as e:
+			# We can't tell whether anything is stale
+			self.complain(e)
+			return fn()
+		generations = [ int(generation or 0) for generation in generations ]
+
+		# Both tiers hold the JSON, so every caller gets its own copy of the
+		# result to mangle as it sees fit
+		now = time.time()
+		if key in self.local:
+			entry = self.local.pop(key)
+			if entry['generations'] == generations and now < entry['expires']:
+				self.local[key] = entry
+				return json.loads(entry['result'])
+
+		if shared is not None:
+			entry = json.loads(shared)
+			if entry['generations'] == generations:
+				self.remember_locally(key, entry)
+				return json.loads(entry['result'])
+
+		result = fn()
+		entry = { 'generations': generations, 'expires': now + self.max_age, 'result': json.dumps(result) }
+		self.remember_locally(key, entry)
+		try:
+			self.conn.setex(search_cache_key(key), self.max_age, json.dumps(entry))
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+		return result
+
+	def remember_locally(self, key, entry):
+		self.local[key] = entry
+		while len(self.local) > self.size:
+			self.local.popitem(last=False)
+
+	def invalidate(self, doc_types):
+		"These indices have changed, anything we cached from them is stale"
+		try:
+			pipeline = self.conn.pipeline(transaction=False)
+			for doc_type in set(doc_types):
+				pipeline.incr(generation_key(doc_type))
+			pipeline.execute()
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+
+
+_search_cache = None
+
+def search_cache():
+	global _search_cache
+	if _search_cache is None:
+		redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
+		redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
+		_search_cache = SearchCache(redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0))
+	return _search_cache
+
+
+# Some documents are more useful than others, whatever you searched for.
+# Rather than working that out for every candidate document on every search,
+# each document gets a static_boost when it's indexed, from the rules below,
+# and searches multiply the score by it. A document's static_boost is the
+# product of the boosts of all the rules that it matches.
+#
+# Each rule is (field, test, value, boost), where the test is one of:
+#   is           the field is exactly the value
+#   has_words    the field has all the words in the value, like field:(a AND b)
+#   has_phrase   the field has the words in the value in a row, like field:"a/b"
+#
+# If you change the rules, run util_update_static_boost.py to bring the
+# documents that are already indexed up to date.
+STATIC_BOOST_RULES = (
+	# Goal: Provsys ranks highest, then new gollum docs, then old Map wiki, then RT tickets.
+	( 'doc_type', 'is',         'provsys',                     3.0 ),
+	( 'doc_type', 'is',         'docs',                        2.0 ),
+	( 'doc_type', 'is',         'map',                         1.8 ),
+	# Funnel pages are low-value
+	( 'url',      'has_words',  'Funnel Sales',                0.5 ),
+	# CSR Procedures are especially useful
+	( 'url',      'has_phrase', 'CustomerService/Procedures',  2.5 ),
+)
+
+def words_of(text):
+	"Roughly what the standard analyser makes of some text"
+	return re.findall(r'\w+', unicode(text).lower(), re.UNICODE)
+
+def matches_rule(document, field, test, value):
+	if field not in document or document[field] is None:
+		return False
+	if test == 'is':
+		return document[field] == value
+	words  = words_of(document[field])
+	wanted = words_of(value)
+	if test == 'has_words':
+		return set(wanted) <= set(words)
+	if test == 'has_phrase':
+		return any( words[i:i+len(wanted)] == wanted for i in range(len(words) - len(wanted) + 1) )
+	raise ValueError("Unknown static boost test: {0}".format(test))
+
+def static_boost(document):
+	"How much more (or less) useful this document is than the average one"
+	boost = 1.0
+	for (field, test, value, rule_boost) in STATIC_BOOST_RULES:
+		if matches_rule(document, field, test, value):
+			boost *= rule_boost
+	return boost
+
+
+def prepare_document(document):
+	"""Sanity check the document and decorate it with our own metadata,
+	returning the (index_name, doc_type, key) needed to store it"""
 
 	# Sanity check the document. Our minimal requirement for the document
 	# is that it has a 'blob' and 'url' key, but ES will support much
@@ -71,6 +381,14 @@ def add_to_index(document):
 	if 'blob' not in document:
 		raise InvalidDocument("The document MUST have a 'blob' field, cannot add to index: {0}".format(document))
 
+	key = document['url']
+
+	doc_type = determine_doc_type(key)
+	if doc_type is None:
+		raise LookupError("We don't have a module that can handle that URL: {0}".format(key))
+
+	index_name = "umad_%s" % doc_type
+
 	# Pass the document's type along as extra metadata, for the renderer's
 	# benefit.
 	document['doc_type'] = doc_type
@@ -78,16 +396,84 @@ def add_to_index(document):
 	# Get the current time in UTC and set `last_indexed` on the document
 	document['last_indexed'] = datetime.datetime.now(tzutc())
 
+	document['static_boost'] = static_boost(document)
+
+	return (index_name, doc_type, key)
+
+
+def add_to_index(document):
+	(index_name, doc_type, key) = prepare_document(document)
+
+	entry = (doc_type, key, fingerprint(document))
+	if fingerprint_cache().unchanged([entry])[0]:
+		return
+
 	es.index(
 		index = index_name,
 		doc_type = doc_type,
 		id = key,
 		body = document
 	)
+	fingerprint_cache().remember([entry])
+	search_cache().invalidate([doc_type])
 
 	return
 
 
+def bulk_add_to_index(documents):
+	"""Index a batch of documents in a single round trip to ES.
+
+	One bad document shouldn't sink the whole batch, so we return a list of
+	(url, error) tuples for the documents that didn't make it, and the
+	caller can decide what to do about them. An empty list means everything
+	was indexed successfully."""
+
+	failures = []
+	prepared = []
+	for document in documents:
+		try:
+			(index_name, doc_type, key) = prepare_document(document)
+		except Exception as e:
+			failures.append( (document.get('url'), e) )
+			continue
+		prepared.append( (index_name, doc_type, key, document) )
+
+	# Unchanged documents don't need writing at all
+	entries = [ (doc_type, key, fingerprint(document)) for (index_name, doc_type, key, document) in prepared ]
+	unchanged = fingerprint_cache().unchanged(entries)
+
+	actions = []
+	written = []
+	for ((index_name, doc_type, key, document), entry, skip) in zip(prepared, entries, unchanged):
+		if skip:
+			continue
+		written.append(entry)
+		actions.append({
+			'_op_type': 'index',
+			'_index':   index_name,
+			'_type':    doc_type,
+			'_id':      key,
+			'_source':  document,
+		})
+
+	if not actions:
+		return failures
+
+	# Each failed item looks like:  { 'index': { '_id': url, 'status': 400, 'error': "..." } }
+	(success_count, errors) = elasticsearch.helpers.bulk(es, actions, raise_on_error=False)
+	failed_keys = set()
+	for error in errors:
+		item = error.get('index', error)
+		failures.append( (item.get('_id'), item.get('error', item)) )
+		failed_keys.add(item.get('_id'))
+
+	fingerprint_cache().remember([ entry for entry in written if entry[1] not in failed_keys ])
+	# Even the failures might have been partly written
+	search_cache().invalidate([ doc_type for (doc_type, key, fp) in written ])
+
+	return failures
+
+
 # Useful for cleaning up mistakes when docs get indexed incorrectly, eg.:
 # >>> import elasticsearch_backend
 # >>> elasticsearch_backend.delete_from_index('https://docs.anchor.net.au/some/obsolete/page')
@@ -105,25 +491,71 @@ def delete_from_index(url):
 	except elasticsearch.exceptions.NotFoundError as e:
 		pass
 
+	fingerprint_cache().forget(doc_type, url)
+	search_cache().invalidate([doc_type])
+
 	return
 
 
+# Whether a query is valid doesn't change, so we remember the last few
+# thousand answers for good
+VALID_QUERY_MEMO_SIZE = int(os.environ.get('UMAD_VALID_QUERY_MEMO_SIZE', 5000))
+valid_query_memo = OrderedDict()
+
 def valid_search_query(search_term):
 	"Return True/False as to whether the query is valid"
-	# XXX: This could probably just be "_all" for the index.
-	test_results = indices.validate_query(index="_all", q=search_term)
-	return test_results[u'valid']
-
-def type_boost(doctype, boost_factor):
-	return { "boost_factor": boost_factor, "filter": { "type": { "value": doctype } } }
+	if search_term in valid_query_memo:
+		valid = valid_query_memo.pop(search_term)
+		valid_query_memo[search_term] = valid
+		return valid
+
+	# Most queries are simple enough to check without bothering ES
+	valid = check_query_string(search_term)
+	if valid is None:
+		def validate():
+			# XXX: This could probably just be "_all" for the index.
+			test_results = indices.validate_query(index="_all", q=search_term)
+			return test_results[u'valid']
+		valid = search_cache().cached('valid', search_term, 0, KNOWN_DOC_TYPES, validate)
+
+	valid_query_memo[search_term] = valid
+	while len(valid_query_memo) > VALID_QUERY_MEMO_SIZE:
+		valid_query_memo.popitem(last=False)
+	return valid
+
+def static_boost_factor():
+	# Documents indexed before static_boost was a thing don't have one
+	return { "field_value_factor": { "field": "static_boost", "missing": 1.0 } }
 
 def linear_deweight_for_age(scale='28d'):
 	# We can mix this in for RT tickets and any documents with a "last_updated" field.
 	# The default decay factor is 0.5, meaning that the score is halved for every 28 days of age.
 	return { "gauss": { "last_updated": { "scale": scale } } }
 
+# How much of a document's text we show in its search result
+EXTRACT_LENGTH = 200
+
+# Blobs can be huge, and we only show a bit of them, which ES can pick out
+# for us with the highlighter. We don't need the rest of them.
+EXCLUDED_SOURCE_FIELDS = [ "blob", "public_blob" ]
+
+def build_extract(source, highlight):
+	"""A short snippet of HTML to show for the hit. ES pre-escapes the
+	highlight fragments for us, so the renderer shouldn't escape it."""
+	# The highlighted excerpt if there's a match in it
+	if highlight.get('excerpt'): # None (False) if not present, or empty list (False), or populated list (True)
+		return highlight['excerpt'][0]
+	# Otherwise the excerpt if we have it
+	if source.get('excerpt'):
+		return cgi.escape(source['excerpt'][:EXTRACT_LENGTH])
+	# And if that doesn't exist either, the best bit of the blob, or the
+	# start of it if nothing matched
+	if highlight.get('blob'):
+		return highlight['blob'][0]
+	return u''
+
 def build_hit(doc):
-	source = doc['_source']
+	source = doc.get('_source', {})
 	# Highlight data is only present if the highlighter found something relevant.
 	# Fake it up if necessary so the later code can make clean assumptions.
 	if not 'highlight' in doc:
@@ -132,31 +564,27 @@ def build_hit(doc):
 		'id':             doc['_id'],
 		'score':          doc['_score'],
 		'type':           doc['_type'],
-		'blob':           source['blob'],
+		'extract':        build_extract(source, doc['highlight']),
 		'other_metadata': source,
 		'highlight':      doc['highlight']
 	}
 	if 'url' in hit['other_metadata']:
 		del(hit['other_metadata']['url'])
-	if 'blob' in hit['other_metadata']:
-		del(hit['other_metadata']['blob'])
 
 	# A hit looks like this:
 	# {
 	#     'other_metadata':
 	#         {
-	#             u'url':      u'http://www.imdb.com/title/tt1319708/',
 	#             u'customer': u'Hyron',
-	#             u'blob':     u"I didn't ask for this",
 	#             u'name':     u'Deus Ex: Human Revolution'
 	#         },
-	#     'score': 0.095891505000000002,
-	#     'type':  u'quote_page',
-	#     'id':    u'http://www.imdb.com/title/tt1319708/',
-	#     'blob':  u"I didn't ask for this",
+	#     'score':   0.095891505000000002,
+	#     'type':    u'quote_page',
+	#     'id':      u'http://www.imdb.com/title/tt1319708/',
+	#     'extract': u"I didn't ask for <strong>this</strong>",
 	#     'highlight':
 	#         {
-	#             u'blob':    [ u"list", u"of", u"highlighted", u"blob", u"fragments" ],
+	#             u'blob':    [ u"singleton list of the best blob fragment, highlighted up" ],
 	#             u'excerpt': [ u"singleton list of the excerpt, highlighted up" ],
 	#         }
 	# }
@@ -164,70 +592,124 @@ def build_hit(doc):
 	return hit
 
 
-def search_index(search_term, max_hits=0):
-	all_hits = []
-
-	# Perform one query for each backend, because we might have tainted indices that we
-	# don't want to touch.
-	for backend in KNOWN_DOC_TYPES:
-		q_dict = {
-			"query": {
-				"function_score": {
-					"functions": [
-						# This is a dummy boost, as ES complains if there are no functions to run.
-						{ "boost_factor": 1.0 },
-						# Goal: Provsys ranks highest, then new gollum docs, then old Map wiki, then RT tickets.
-						type_boost('provsys', 3.0),
-						type_boost('gollum',  2.0),
-						type_boost('map',     1.8),
-						# Funnel pages are low-value
-						{ "boost_factor": 0.5, "filter": { "query": { "query_string": { "query": "url:(Funnel AND Sales)" } } } },
-						# CSR Procedures are especially useful
-						{ "boost_factor": 2.5, "filter": { "query": { "query_string": { "query": "url:\"CustomerService/Procedures\"" } } } },
-					],
-					"query": {
-						"query_string": {
-							"query": search_term,
-							"default_operator": "and",
-							"fields": [ "title^1.5", "customer_name", "blob" ]
-						}
-					},
-					"score_mode": "multiply"
-				}
-			},
-			"highlight": {
-				"pre_tags": [ "<strong>" ],
-				"post_tags": [ "</strong>" ],
-				# Pre-escape the highlight fragments treating them as HTML content, then slap our highlighting tags on
-				"encoder": "html",
-				"fragment_size": 200,
-				"fields": {
-					"blob": {},
-					"excerpt": {
-						# Don't break down excerpt fields, they're ready-to-consume
-						"number_of_fragments": 1
-					}
+def build_query(backend, search_term, max_hits=0, filters=()):
+	"""The search body for one doc_type's index. Documents have to match all
+	the `filters` as well, see search_query."""
+	query_string = {
+		"query": search_term,
+		"default_operator": "and",
+		"fields": [ "title^1.5", "customer_name", "blob" ]
+	}
+	if backend == 'rt':
+		# Searching for RT ticket numbers is highly appropriate.
+		query_string['fields'].append("local_id^3")
+
+	# Nothing but a doc_type or filters, eg. "rt:", then everything that
+	# passes them is a match
+	query = { "query_string": query_string }
+	if not search_term.strip():
+		query = { "match_all": {} }
+	if filters:
+		query = { "filtered": { "query": query, "filter": { "bool": { "must": list(filters) } } } }
+
+	q_dict = {
+		"query": {
+			"function_score": {
+				"functions": [
+					# Worked out when the document was indexed, see STATIC_BOOST_RULES
+					static_boost_factor(),
+				],
+				"query": query,
+				"score_mode": "multiply"
+			}
+		},
+		"_source": { "exclude": EXCLUDED_SOURCE_FIELDS },
+		"highlight": {
+			"pre_tags": [ "<strong>" ],
+			"post_tags": [ "</strong>" ],
+			# Pre-escape the highlight fragments treating them as HTML content, then slap our highlighting tags on
+			"encoder": "html",
+			"fragment_size": EXTRACT_LENGTH,
+			"fields": {
+				"blob": {
+					# We only ever show one, and we want the start of
+					# the blob if nothing in it matched
+					"number_of_fragments": 1,
+					"no_match_size": EXTRACT_LENGTH
+				},
+				"excerpt": {
+					# Don't break down excerpt fields, they're ready-to-consume
+					"number_of_fragments": 1
 				}
 			}
 		}
+	}
 
-		if backend == 'rt':
-			# We *should* be able to mix this in with a filter so that it only applies to rt documents,
-			# but that doesn't seem to work and all the non-rt shards complain.
-			q_dict['query']['function_score']['functions'].append(linear_deweight_for_age())
-			# Searching for RT ticket numbers is highly appropriate.
-			q_dict['query']['function_score']['query']['query_string']['fields'].append("local_id^3")
+	if backend == 'rt':
+		# We *should* be able to mix this in with a filter so that it only applies to rt documents,
+		# but that doesn't seem to work and all the non-rt shards complain.
+		q_dict['query']['function_score']['functions'].append(linear_deweight_for_age())
 
-		idx_name = "umad_{0}".format
+	if max_hits:
+		q_dict['size'] = max_hits # ES defaults to 10
 
+	return q_dict
+
+
+def is_missing_index(error):
+	"Does an msearch error just mean that the index doesn't exist yet?"
+	if isinstance(error, dict):
+		error = error.get('type', '') + ' ' + json.dumps(error.get('root_cause', []))
+	return 'IndexMissingException' in error or 'index_not_found_exception' in error
+
+
+def is_query_error(error):
+	"""Does a search error mean that ES couldn't make sense of the query,
+	rather than that something's broken?"""
+	if isinstance(error, dict):
+		error = error.get('type', '') + ' ' + json.dumps(error.get('root_cause', []))
+	error = unicode(error)
+	return 'QueryParsingException' in error or 'query_parsing_exception' in error or 'Failed to parse query' in error
+
+
+def search_index(search_term, max_hits=0, doc_types=None, filters=()):
+	"""Search the indices for all the doc_types we know about, or only the
+	ones in `doc_types` if the query can't match anything else, for
+	documents that match all the `filters`. Results are cached until one of
+	those indices changes."""
+	if doc_types is None:
+		doc_types = KNOWN_DOC_TYPES
+	doc_types = KNOWN_DOC_TYPES & set(doc_types)
+	return search_cache().cached('search', search_term, max_hits, doc_types, lambda: search_indices(search_term, max_hits, doc_types, filters), filters=list(filters))
+
+
+def search_indices(search_term, max_hits, doc_types, filters=()):
+	"search_index() without the cache"
+	all_hits = []
+
+	# Each backend gets its own query in its own index, because we might have
+	# tainted indices that we don't want to touch, and some doc_types have
+	# their own tweaks. They all go to ES as one multi-search, so we only
+	# wait for the slowest of them instead of all of them in turn.
+	backends = sorted(doc_types)
+	idx_name = "umad_{0}".format
+
+	if not backends:
+		return {'hits':all_hits, 'hit_limit':max_hits}
+
+	body = []
+	for backend in backends:
 		# Don't freak out if some indices don't exist yet.
-		try:
-			if max_hits:
-				results = es.search(index=idx_name(backend), body=q_dict, size=max_hits)
-			else:
-				results = es.search(index=idx_name(backend), body=q_dict) # ES defaults to 10
-		except elasticsearch.NotFoundError as e:
-			continue
+		body.append({ "index": idx_name(backend), "ignore_unavailable": True })
+		body.append(build_query(backend, search_term, max_hits, filters))
+
+	responses = es.msearch(body=body)['responses']
+
+	for (backend, results) in zip(backends, responses):
+		if 'error' in results:
+			if is_missing_index(results['error']):
+				continue
+			raise elasticsearch.TransportError(results.get('status', 500), results['error'])
 
 		docs = results['hits']['hits']
 		hits = [ build_hit(doc) for doc in docs ]
@@ -0,0 +1,159 @@
+# Index templates, one per doc_type, so that the umad_* indices get a mapping
+# that we chose instead of whatever ES guesses from the first documents.
+#
+# Left to its own devices ES analyses everything as full text, so a search for
+# status:open or customer_id:1234 is at the mercy of the tokeniser, and every
+# new key that a distiller invents becomes a new field in the mapping forever.
+# So we say which fields are exact keywords and which are text, and refuse
+# (dynamic: strict) documents with fields we haven't heard of. The indexing
+# worker reports those as failed documents, which is a good prompt to come and
+# add the field here.
+#
+# Domains are the exception: DomainDistiller copies whatever tld_data the
+# registry gives it into the document. Those fields stay in _source, so they
+# still show up in the metadata, but they're not indexed (dynamic: false).
+#
+# _all is turned off, queries always name their fields (see build_query), and
+# the odd query that doesn't gets blob. Norms are only kept on the fields that
+# we score against, where the length of the field matters.
+#
+# Templates only apply when an index is created. If you change a mapping, bump
+# INDEX_TEMPLATE_VERSION, run util_install_index_templates.py, then delete the
+# affected indices, run it again with --create-indices, and re-enqueue their
+# URLs. The version is recorded in each mapping's _meta so that you can tell
+# which indices are out of date.
+
+INDEX_TEMPLATE_VERSION = 1
+
+# Field types, in ES 1.x terms
+TEXT       = { "type": "string" }
+SHORT_TEXT = { "type": "string", "norms": { "enabled": False } }
+KEYWORD    = { "type": "string", "index": "not_analyzed" }
+DATE       = { "type": "date" }
+INTEGER    = { "type": "integer" }
+FLOAT      = { "type": "float" }
+BOOLEAN    = { "type": "boolean" }
+
+# Every document has these, see prepare_document
+COMMON_FIELDS = {
+	'url':           SHORT_TEXT,
+	'blob':          TEXT,
+	'title':         TEXT,
+	'excerpt':       SHORT_TEXT,
+	'local_id':      KEYWORD,
+	'customer_name': TEXT,
+	'last_updated':  DATE,
+	'doc_type':      KEYWORD,
+	'last_indexed':  DATE,
+	'static_boost':  FLOAT,
+}
+
+DOC_TYPE_FIELDS = {
+	'rt': {
+		'subject':          SHORT_TEXT,
+		'status':           KEYWORD,
+		'queue':            KEYWORD,
+		'category':         KEYWORD,
+		'priority':         INTEGER,
+		'realname':         SHORT_TEXT,
+		'email':            KEYWORD,
+		'customer_visible': BOOLEAN,
+		'public_blob':      TEXT,
+		'last_contact':     DATE,
+		'customer_id':      KEYWORD,
+		'customer_url':     KEYWORD,
+		'customer':         SHORT_TEXT,
+	},
+	'customer': {
+		'customer_id':        KEYWORD,
+		'functional_url':     { "type": "string", "index": "no" },
+		'primary_contacts':   SHORT_TEXT,
+		'billing_contacts':   SHORT_TEXT,
+		'technical_contacts': SHORT_TEXT,
+		'tenancies':          KEYWORD,
+	},
+	'domain': {
+		'name':            SHORT_TEXT,
+		'customer_id':     KEYWORD,
+		'expiry':          DATE,
+		'created':         DATE,
+		'updated':         DATE,
+		'nameservers':     KEYWORD,
+		'au_registrant':   SHORT_TEXT,
+		'tech_contact':    SHORT_TEXT,
+		'admin_contact':   SHORT_TEXT,
+		'billing_contact': SHORT_TEXT,
+		# OpenSRS gives us the whole contact, we only search on some of it
+		'owner_contact': {
+			"type": "object",
+			"dynamic": False,
+			"properties": {
+				'first_name': SHORT_TEXT,
+				'last_name':  SHORT_TEXT,
+				'org_name':   SHORT_TEXT,
+				'email':      KEYWORD,
+			}
+		},
+	},
+	'provsys': {
+		'name':                  SHORT_TEXT,
+		'customer_id':           KEYWORD,
+		'customer':              SHORT_TEXT,
+		'location':              SHORT_TEXT,
+		'lifecycle_status':      KEYWORD,
+		'description':           SHORT_TEXT,
+		# VLANs
+		'vlan_id':               KEYWORD,
+		'vlan_shortname':        KEYWORD,
+		'vlan_longname':         SHORT_TEXT,
+		# Servers
+		'distro':                KEYWORD,
+		'version':               SHORT_TEXT,
+		'os_wordsize':           KEYWORD,
+		'container':             SHORT_TEXT,
+		'machinetype':           SHORT_TEXT,
+		'support':               KEYWORD,
+		'maint_weekday':         KEYWORD,
+		'maint_hour':            INTEGER,
+		'maint_minute':          INTEGER,
+		'maint_duration':        KEYWORD,
+		'maint_time':            KEYWORD,
+		'support_notes':         SHORT_TEXT,
+		'chassis_support_notes': SHORT_TEXT,
+	},
+	'docs':    {},
+	'map':     {},
+}
+
+# Doc_types whose documents can have fields we don't know about in advance
+UNINDEXED_EXTRA_FIELDS = ('domain',)
+
+
+def index_mapping(doc_type):
+	"The mapping for this doc_type, with our version in _meta"
+	properties = dict(COMMON_FIELDS)
+	properties.update(DOC_TYPE_FIELDS[doc_type])
+	return {
+		"_all": { "enabled": False },
+		"_meta": { "umad_template_version": INDEX_TEMPLATE_VERSION },
+		"dynamic": False if doc_type in UNINDEXED_EXTRA_FIELDS else "strict",
+		"properties": properties,
+	}
+
+
+def index_template(doc_type):
+	"The index template for umad_<doc_type>, ready for indices.put_template"
+	return {
+		"template": "umad_{0}".format(doc_type),
+		"settings": {
+			"index.query.default_field": "blob",
+		},
+		"mappings": {
+			doc_type: index_mapping(doc_type),
+		},
+	}
+
+
+def template_version(mapping):
+	"Which version of our mapping an index or template has, None if it predates them"
+	return mapping.get('_meta', {}).get('umad_template_version')
@@ -0,0 +1,225 @@
+import re
+
+# Checking whether ES will accept a query_string query, without asking ES.
+#
+# This follows the grammar of Lucene's classic QueryParser, which is what
+# query_string uses, for the bits of it that people actually type into the
+# search box: terms, wildcards, "phrases", (groups), field:values, AND/OR/NOT
+# and && || !, +required and -prohibited clauses, fuzziness~ and boosts^2.
+#
+# Anything fancier, like [ranges TO them] and /regexes/, or searching a field
+# we don't know to be plain text, gets a shrug (None), and the caller should
+# ask ES instead.
+
+# Fields that any value is fine for. Others might be numbers or dates, and
+# then it depends on the value, eg. local_id:banana.
+TEXT_FIELDS = ('_type', 'title', 'blob', 'excerpt', 'customer_name', 'url', 'name')
+
+# Characters that can't appear in a term unless they're escaped
+SPECIAL_CHARS = u' \t\n\r\u3000+-!():^[]"{}~\\/'
+
+NUMBER       = re.compile(r'\d+(\.\d+)?')
+WHOLE_NUMBER = re.compile(r'\d+(\.\d+)?$')
+
+# Token types
+TERM, PHRASE, COLON, LPAREN, RPAREN, AND, OR, NOT, PLUS, MINUS, CARAT, TILDE = range(12)
+
+
+class QuerySyntaxError(Exception): pass
+class Unsure(Exception): pass
+
+
+def tokenise(query):
+	"""Split the query into (type, text, spaced) tokens, like Lucene's lexer
+	would. `spaced` is True if there was whitespace right before the token."""
+	tokens = []
+	i = 0
+	spaced = True
+	def append(token_type, text):
+		tokens.append( (token_type, text, spaced) )
+	while i < len(query):
+		c = query[i]
+		if c in u' \t\n\r\u3000':
+			i += 1
+			spaced = True
+			continue
+		elif c == '"':
+			end = i + 1
+			while end < len(query) and query[end] != '"':
+				end += 2 if query[end] == '\\' else 1
+			if end >= len(query):
+				raise QuerySyntaxError("Unterminated phrase")
+			append(PHRASE, query[i+1:end])
+			i = end + 1
+		elif query.startswith('&&', i) or query.startswith('||', i):
+			append(AND if c == '&' else OR, query[i:i+2])
+			i += 2
+		elif c in '()+-!:^~':
+			append({ '(': LPAREN, ')': RPAREN, '+': PLUS, '-': MINUS, '!': NOT, ':': COLON, '^': CARAT, '~': TILDE }[c], c)
+			i += 1
+		elif c in '[]{}/':
+			# Ranges and regexes, we'd rather not
+			raise Unsure(c)
+		else:
+			# A term runs until the next special character. + and - are only
+			# special at the start of one.
+			end = i
+			while end < len(query):
+				if query[end] == '\\':
+					if end + 1 >= len(query):
+						raise QuerySyntaxError("Nothing to escape at the end of the query")
+					end += 2
+					continue
+				if query[end] in SPECIAL_CHARS and not (end > i and query[end] in '+-'):
+					break
+				if query.startswith('&&', end) or query.startswith('||', end):
+					break
+				end += 1
+			term = query[i:end]
+			append({ 'AND': AND, 'OR': OR, 'NOT': NOT }.get(term, TERM), term)
+			i = end
+		spaced = False
+	return tokens
+
+
+class Parser(object):
+	"""Recursive descent over the tokens, following QueryParser.jj:
+
+	  Query     ::= Modifier? Clause ( Conjunction? Modifier? Clause )*
+	  Clause    ::= ( TERM COLON )? ( Term | LPAREN Query RPAREN Boost? )
+	  Term      ::= ( TERM | PHRASE ) ( Fuzzy | Boost )*
+	"""
+
+	def __init__(self, tokens):
+		self.tokens   = tokens
+		self.position = 0
+
+	def peek(self, offset=0):
+		if self.position + offset < len(self.tokens):
+			return self.tokens[self.position + offset][0]
+		return None
+
+	def spaced(self):
+		"Is there whitespace before the next token?"
+		return self.position < len(self.tokens) and self.tokens[self.position][2]
+
+	def take(self, *expected):
+		if self.peek() not in expected:
+			raise QuerySyntaxError("Unexpected {0!r}".format(self.tokens[self.position][1] if self.peek() is not None else 'end of query'))
+		token = self.tokens[self.position]
+		self.position += 1
+		return token
+
+	def parse(self):
+		self.query()
+		if self.peek() is not None:
+			raise QuerySyntaxError("Unexpected {0!r}".format(self.tokens[self.position][1]))
+
+	def query(self):
+		self.clause()
+		while self.peek() not in (None, RPAREN):
+			if self.peek() in (AND, OR):
+				self.take(AND, OR)
+			self.clause()
+
+	def clause(self):
+		if self.peek() in (PLUS, MINUS, NOT):
+			self.take(PLUS, MINUS, NOT)
+
+		if self.peek() == TERM and self.peek(1) == COLON:
+			(token_type, field, spaced) = self.take(TERM)
+			self.take(COLON)
+			if field not in TEXT_FIELDS:
+				raise Unsure(field)
+
+		if self.peek() == LPAREN:
+			self.take(LPAREN)
+			self.query()
+			self.take(RPAREN)
+			self.modifiers(fuzzy=False)
+		else:
+			(token_type, text, spaced) = self.take(TERM, PHRASE)
+			self.modifiers(phrase=(token_type == PHRASE))
+
+	def modifiers(self, fuzzy=True, phrase=False):
+		"""At most one fuzziness, then at most one boost. Boosts have a
+		number, fuzziness might, and either way it comes straight after the ^
+		or ~. Lucene allows a few odder combinations for terms, like foo^2~,
+		but we leave those to ES."""
+		if self.peek() == TILDE:
+			if not fuzzy:
+				raise QuerySyntaxError("Can't make a group fuzzy")
+			self.take(TILDE)
+			if self.peek() == TERM and not self.spaced() and NUMBER.match(self.tokens[self.position][1]):
+				(token_type, number, spaced) = self.take(TERM)
+				if not WHOLE_NUMBER.match(number):
+					# Lucene would split foo~2x into foo~2 and x, probably
+					raise Unsure(number)
+				if not phrase:
+					edits = float(number)
+					if edits >= 1 and edits != int(edits):
+						raise QuerySyntaxError("Fractional edit distances are not allowed")
+					if edits > 2:
+						# Lucene caps it at 2, ES might not be so forgiving
+						raise Unsure(number)
+		if self.peek() == CARAT:
+			self.take(CARAT)
+			if self.peek() != TERM or self.spaced():
+				raise QuerySyntaxError("Boosts need a number straight after the ^")
+			(token_type, number, spaced) = self.take(TERM)
+			if not WHOLE_NUMBER.match(number):
+				if NUMBER.match(number):
+					# As above, foo^2x
+					raise Unsure(number)
+				raise QuerySyntaxError("Boosts need a number, not {0!r}".format(number))
+		if self.peek() in (CARAT, TILDE):
+			raise Unsure(self.tokens[self.position][1])
+
+
+def check_query_string(query):
+	"""Would ES accept this as a query_string query? True if so, False if it
+	definitely wouldn't, or None if we can't tell and you'll have to ask"""
+	if not query.strip():
+		return None
+	try:
+		Parser(tokenise(query)).parse()
+	except QuerySyntaxError:
+		return False
+	except Unsure:
+		return None
+	return True
+
+
+# Some answers we know to be right, for checking any changes to the above:
+#   python lucene_syntax.py
+EXAMPLES = (
+	( u'foo',                 True  ),
+	( u'title:"a b"~2^3',     True  ),
+	( u'foo~2',               True  ),
+	( u'foo~0.5^2',           True  ),
+	( u'foo~1.0',             True  ),
+	( u'"a b"~1.5',           True  ),
+	( u'foo~ 1.5',            True  ),
+	( u'foo^2',               True  ),
+	( u'(a b)^2',             True  ),
+	( u'foo~1.5',             False ),
+	( u'foo^ 2',              False ),
+	( u'foo^',                False ),
+	( u'foo^x',               False ),
+	( u'(a b)~2',             False ),
+	( u'"a b',                False ),
+	( u'foo~~',               None  ),
+	( u'foo^2^3',             None  ),
+	( u'"a b"~2~3',           None  ),
+	( u'foo^2~',              None  ),
+	( u'foo~5',               None  ),
+	( u'foo^2x',              None  ),
+	( u'local_id:banana',     None  ),
+)
+
+if __name__ == '__main__':
+	import sys
+	wrong = [ (query, expected, check_query_string(query)) for (query, expected) in EXAMPLES if check_query_string(query) != expected ]
+	for (query, expected, got) in wrong:
+		print u"{0!r}: expected {1}, got {2}".format(query, expected, got)
+	sys.exit(1 if wrong else 0)
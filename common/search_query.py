@@ -0,0 +1,150 @@
+import re
+
+# Turning what people type into the search box into an ES query.
+#
+# Restrictions like "only RT tickets for this customer that are still open"
+# are yes/no questions, there's no point scoring them. So instead of
+# mangling them into the query_string, we pull them out as ES filters, which
+# are cheap and get cached and reused across queries. Only the free text
+# that's left over is scored.
+#
+# We understand these prefixes:
+#
+#   rt: emergency                 only search RT, if it comes first (also the
+#                                 other doc_types, and the aliases below)
+#   doctype:rt                    the same, anywhere in the query
+#   customer:anchor               customer_name matches, use "quotes" for
+#                                 more than one word
+#   status:open                   eg. RT tickets by status
+#   after:2015-01-01 before:now   last_updated is in that range, dates are
+#                                 YYYY[-MM[-DD]] or ES date maths like now-7d
+#
+# Prefixes are only pulled out when they stand on their own at the top level
+# of the query. If they're in (parentheses), or next to an AND, OR or NOT,
+# they're left for query_string to deal with, so that we don't change what
+# the query means.
+
+# Some people use synonyms for the doctypes
+DOC_TYPE_ALIASES = {
+	'domains': 'domain',
+	'customers': 'customer',
+	'wiki': 'map',
+	'server': 'provsys',
+}
+
+PREFIXES = ('doctype', 'customer', 'status', 'after', 'before')
+
+DATE = re.compile(r'^(\d{4}(-\d{2}(-\d{2})?)?|now([+-]\d+[yMwdhms])*(/[yMwdhms])?)$')
+
+# Words that tie a prefix to the rest of the query
+OPERATORS = ('AND', '&&', 'OR', '||', 'NOT', '!')
+
+
+class InvalidQuery(ValueError): pass
+
+
+class ParsedQuery(object):
+	"""What we made of a query: the free `text` for query_string, the
+	`doc_types` to search (None for all of them), and a list of ES
+	`filters` that documents must match"""
+
+	def __init__(self, text, doc_types, filters):
+		self.text      = text
+		self.doc_types = doc_types
+		self.filters   = filters
+
+	def __repr__(self):
+		return "ParsedQuery({0!r}, {1!r}, {2!r})".format(self.text, self.doc_types, self.filters)
+
+
+def split_words(query):
+	"""Split on whitespace, keeping "quoted phrases" together, and noting
+	how deep in parentheses each word is. Returns (word, depth) tuples."""
+	words = []
+	word  = u''
+	depth = 0
+	quoted = False
+	for c in query:
+		if c == '"':
+			quoted = not quoted
+		elif not quoted and c.isspace():
+			if word:
+				words.append( (word, depth) )
+				word = u''
+			continue
+		elif not quoted and c == '(':
+			depth += 1
+		elif not quoted and c == ')':
+			depth = max(0, depth - 1)
+		word += c
+	if word:
+		words.append( (word, depth) )
+	return words
+
+
+def unquote(value):
+	if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+		return value[1:-1]
+	return value
+
+
+def doc_type_named(name, known_doc_types):
+	name = name.lower()
+	name = DOC_TYPE_ALIASES.get(name, name)
+	return name if name in known_doc_types else None
+
+
+def compile_filter(prefix, value):
+	"The ES filter for one prefix:value"
+	if not value:
+		raise InvalidQuery(u"{0}: needs something to look for".format(prefix))
+
+	if prefix == 'customer':
+		# customer_name is analysed, so it's a query rather than a term.
+		# Query filters aren't cached by default, but this one's worth it.
+		return { "fquery": { "query": { "match_phrase": { "customer_name": value } }, "_cache": True } }
+	if prefix == 'status':
+		return { "term": { "status": value.lower() } }
+	if prefix in ('after', 'before'):
+		if not DATE.match(value):
+			raise InvalidQuery(u"{0}: needs a date like 2015-01-31 or now-7d, not {1}".format(prefix, value))
+		return { "range": { "last_updated": { 'gte' if prefix == 'after' else 'lt': value } } }
+	raise InvalidQuery(u"We don't know how to filter on {0}:".format(prefix))
+
+
+def parse_query(query, known_doc_types):
+	"""Pull the doc_type restriction and filters out of a query, returning a
+	ParsedQuery. Raises InvalidQuery if a prefix doesn't make sense."""
+	words = split_words(query)
+
+	doc_types = set()
+	filters   = []
+	text      = []
+
+	# "rt: emergency" or "rt:emergency", for any doc_type or alias. A bare
+	# "customer:" at the front is the customer doc_type, but
+	# "customer:anchor" is a customer filter.
+	if words and words[0][1] == 0 and ':' in words[0][0]:
+		(name, rest) = words[0][0].split(':', 1)
+		doc_type = doc_type_named(name, known_doc_types)
+		if doc_type is not None and not (name.lower() == 'customer' and rest):
+			doc_types.add(doc_type)
+			words = ( [(rest, 0)] if rest else [] ) + words[1:]
+
+	for (i, (word, depth)) in enumerate(words):
+		(prefix, colon, value) = word.partition(':')
+		prefix = prefix.lower()
+		neighbours = [ w for (w, d) in words[max(0, i-1):i] + words[i+1:i+2] ]
+		if colon and prefix in PREFIXES and depth == 0 and not set(neighbours) & set(OPERATORS):
+			value = unquote(value)
+			if prefix == 'doctype':
+				doc_type = doc_type_named(value, known_doc_types)
+				if doc_type is None:
+					raise InvalidQuery(u"We don't have any documents of type {0}".format(value))
+				doc_types.add(doc_type)
+			else:
+				filters.append(compile_filter(prefix, value))
+		else:
+			text.append(word)
+
+	return ParsedQuery(u' '.join(text), sorted(doc_types) or None, filters)
@@ -0,0 +1,873 @@
+import time
+import random
+
+from umad_routing import route, canonicalise, UnroutableURL, DOC_TYPES
+
+# UMAD's work queues live in Redis as sorted sets, URL -> enqueue timestamp.
+# There's a queue for each doc_type, so that a flood of slow RT tickets can't
+# hold up quick wiki edits. Each of those has two lanes: "high" for
+# interactive updates, like someone editing a wiki page, and "low" for bulk
+# backfills. They're named like umad_indexing_queue:rt:high.
+#
+# The queue only says that a URL needs attention. What needs doing, index or
+# delete, is kept alongside in an operation store, and the most recent
+# request for a URL wins. So "index, then delete" in quick succession is a
+# single delete, and we don't bother distilling a page just to throw it
+# away. Every operation gets a sequence number, and when we delete a URL we
+# leave a *tombstone* with the sequence number of the delete. Documents
+# produced by an index that was asked for before the delete won't be written
+# to ES, so they can't bring the deleted document back from the dead.
+# Tombstones are cleared out after a while, once there can't be any older
+# work still floating around.
+#
+# For each doc_type D we keep:
+#   umad_ops:D              HASH   url -> "seq op", the most recent request
+#   umad_tombstones:D       HASH   url -> seq of the delete
+#   umad_tombstone_times:D  ZSET   url -> time of the delete, for clearing them out
+#   umad_op_seq             STRING the last sequence number handed out
+#
+# Workers don't just pop URLs off the queue, because a worker that crashes
+# halfway through would lose them forever. Instead a URL is *claimed*: it
+# moves to an in-flight set, scored by the deadline of the worker's lease on
+# it. Once the document is safely in ES the worker *acks* the URL and it's
+# forgotten. If the lease runs out first, the reaper treats it as a failed
+# attempt (see below), and another worker gets a go later.
+#
+# Enqueueing a URL that's already waiting keeps its original timestamp, so a
+# hot page that's edited over and over doesn't keep going to the back of the
+# queue. Enqueueing a URL that's in flight doesn't put it in the queue, where
+# another worker could pick it up and process it in parallel. Instead we
+# note that it needs a *follow-up* run, and it goes back in the queue once
+# the current run is acked. However many times it's enqueued in the
+# meantime, that's one follow-up run.
+#
+# For a queue named Q we keep:
+#   Q            ZSET   url -> enqueue timestamp
+#   Q:inflight   ZSET   url -> lease deadline
+#   Q:claimed    HASH   url -> original enqueue timestamp, for putting it back
+#   Q:followup   ZSET   url -> earliest enqueue timestamp while it was in flight
+#
+# When processing fails, or a lease expires, the URL goes into a retry set
+# with exponential backoff instead, and is promoted back into the queue once
+# it's due. After too many attempts we give up, and the URL is moved to a
+# dead-letter set for a human to look at, and maybe replay. URLs that can't be
+# processed because their upstream is down are *parked* in the retry set
+# too, but that doesn't use up an attempt.
+#
+#   Q:retry      ZSET   url -> time of the next attempt
+#   Q:attempts   HASH   url -> number of failed attempts so far
+#   Q:dead       ZSET   url -> time we gave up on it
+#   Q:errors     HASH   url -> the most recent error, for the humans
+#
+# To keep an eye on things without rummaging through the sets, the scripts
+# keep some counters as they go. Each minute gets a bucket of how many URLs
+# were enqueued and dequeued (claimed) for each doc_type, which lives for a
+# bit over an hour, and we count the deletes that are waiting to happen.
+#
+#   umad_rates:M           HASH   "D:enqueued" and "D:dequeued" -> count, for minute M since the epoch
+#   umad_queue_stats:D     HASH   pending_deletes -> count
+#
+# Idle workers nap on the "barber" list with BRPOP, and whoever puts work in
+# a queue wakes one of them up. The list holds at most one wakeup, stamped
+# with the time it was sent, so a flood of enqueues is one wakeup rather
+# than a pile of them for the workers to chew through long after the queues
+# are empty. BRPOP hands each wakeup to just one of the napping workers,
+# and if that worker finds more waiting than it can take on, it wakes up
+# the next one (see nap() and wake()). Workers keep count of how that's
+# going, so that we can see the latency and how much time is spent idle.
+#
+#   barber                 LIST   at most one wakeup, the time it was sent
+#   umad_wakeup_stats      HASH   naps, wakeups, timeouts, spurious, latency_seconds, nap_seconds
+
+INDEXING_QUEUE = 'umad_indexing_queue'
+
+INDEX_OP  = 'index'
+DELETE_OP = 'delete'
+OPS       = (INDEX_OP, DELETE_OP)
+
+HIGH_PRIORITY = 'high'
+LOW_PRIORITY  = 'low'
+PRIORITIES    = (HIGH_PRIORITY, LOW_PRIORITY)
+
+queue_for = "{0}:{1}:{2}".format # base, doc_type, lane
+
+# Before there was a queue for each doc_type, everything went into one of
+# these, URL -> enqueue timestamp. Deletions came first, see
+# drain_legacy_queues().
+LEGACY_QUEUES = ( ('umad_deletion_queue', DELETE_OP), (INDEXING_QUEUE, INDEX_OP) )
+LEGACY_DRAIN_CHUNK = 500
+
+def queue_base(queue_name):
+	"umad_indexing_queue:rt:high  ->  umad_indexing_queue"
+	return queue_name.split(':')[0]
+
+def queue_doc_type(queue_name):
+	"umad_indexing_queue:rt:high  ->  rt"
+	return queue_name.split(':')[1]
+
+def queue_lane(queue_name):
+	"umad_indexing_queue:rt:high  ->  high"
+	return queue_name.split(':')[2]
+
+def all_queues(base=INDEXING_QUEUE, doc_types=DOC_TYPES, lanes=PRIORITIES):
+	return [ queue_for(base, doc_type, lane) for lane in lanes for doc_type in doc_types ]
+
+# How long a worker gets to process a URL before we assume it's dead
+DEFAULT_LEASE_SECONDS = 600
+# Retry after 30sec, 1min, 2min, ... but never wait more than an hour
+DEFAULT_MAX_ATTEMPTS      = 5
+DEFAULT_RETRY_DELAY       = 30
+DEFAULT_RETRY_DELAY_LIMIT = 3600
+# Nothing should still be working on a URL a day after it was deleted
+DEFAULT_TOMBSTONE_SECONDS = 86400
+
+ops_key             = "umad_ops:{0}".format
+tombstones_key      = "umad_tombstones:{0}".format
+tombstone_times_key = "umad_tombstone_times:{0}".format
+OP_SEQ_KEY          = "umad_op_seq"
+
+inflight_key = "{0}:inflight".format
+claimed_key  = "{0}:claimed".format
+retry_key    = "{0}:retry".format
+attempts_key = "{0}:attempts".format
+dead_key     = "{0}:dead".format
+errors_key   = "{0}:errors".format
+followup_key = "{0}:followup".format
+
+WAKEUP_KEY       = 'barber'
+WAKEUP_STATS_KEY = 'umad_wakeup_stats'
+
+stats_key = "umad_queue_stats:{0}".format
+rates_key = "umad_rates:{0}".format
+# Long enough to look back over the last hour, plus the minute in progress
+RATES_TTL = 62 * 60
+
+def rates_bucket(now):
+	return rates_key(int(now // 60))
+
+
+# Wake up a worker, unless there's already a wakeup waiting for one
+WAKE_BARBER = """
+local function wake_barber(barber, now)
+	if redis.call('LLEN', barber) == 0 then
+		redis.call('LPUSH', barber, now)
+	end
+end
+"""
+
+# Lua snippets shared by the scripts that finish with a URL
+#
+# Put the follow-up run of a URL into its queue, if one was asked for while
+# it was in flight, keeping the earliest timestamp
+RELEASE_FOLLOWUP = WAKE_BARBER + """
+local function release_followup(url, queue, followup, other_queue, other_followup, barber, now)
+	for _, lane in ipairs({ {queue, followup}, {other_queue, other_followup} }) do
+		local score = redis.call('ZSCORE', lane[2], url)
+		if score then
+			redis.call('ZREM', lane[2], url)
+			local existing = redis.call('ZSCORE', lane[1], url)
+			if not existing or tonumber(existing) > tonumber(score) then
+				redis.call('ZADD', lane[1], score, url)
+			end
+			wake_barber(barber, now)
+		end
+	end
+end
+"""
+# A URL that's going into the retry set will get run again anyway, it
+# doesn't need a follow-up on top of that
+DROP_FOLLOWUP = """
+local function drop_followup(url, followup, other_followup)
+	redis.call('ZREM', followup, url)
+	redis.call('ZREM', other_followup, url)
+end
+"""
+
+
+# A URL should only be waiting in one lane at a time. Asking for high
+# priority promotes it out of the low lane, but asking for low priority
+# doesn't demote something that's already waiting in the high lane. The same
+# goes for follow-ups.
+#
+# KEYS: queue, inflight, followup, retry, then the same for the other lane, barber, ops, op seq, stats, rates bucket
+# ARGV: now, url, "high" or "low", op, "1" to wake the barber, doc_type, rates TTL
+# Returns 1 if the URL was queued, 2 if it's been marked for a follow-up, 0 if it was already waiting in the high lane
+ENQUEUE_SCRIPT = WAKE_BARBER + """
+local url   = ARGV[2]
+local score = tonumber(ARGV[1])
+
+redis.call('HINCRBY', KEYS[13], ARGV[6] .. ':enqueued', 1)
+redis.call('EXPIRE', KEYS[13], ARGV[7])
+
+-- Whatever happens to the URL next, this is what we'll do to it
+local seq = redis.call('INCR', KEYS[11])
+local previous = redis.call('HGET', KEYS[10], url)
+redis.call('HSET', KEYS[10], url, string.format('%d %s', seq, ARGV[4]))
+
+local pending_deletes = 0
+if previous and string.match(previous, '%a+$') == 'delete' then
+	pending_deletes = pending_deletes - 1
+end
+if ARGV[4] == 'delete' then
+	pending_deletes = pending_deletes + 1
+end
+if pending_deletes ~= 0 then
+	redis.call('HINCRBY', KEYS[12], 'pending_deletes', pending_deletes)
+end
+
+-- A fresh request supersedes any retry that was scheduled
+redis.call('ZREM', KEYS[4], url)
+redis.call('ZREM', KEYS[8], url)
+
+local target, other, result = KEYS[1], KEYS[5], 1
+if redis.call('ZSCORE', KEYS[2], url) or redis.call('ZSCORE', KEYS[6], url) then
+	target, other, result = KEYS[3], KEYS[7], 2
+end
+
+local elsewhere = redis.call('ZSCORE', other, url)
+if elsewhere then
+	if ARGV[3] ~= 'high' then
+		return 0
+	end
+	redis.call('ZREM', other, url)
+	score = math.min(score, tonumber(elsewhere))
+end
+
+local existing = redis.call('ZSCORE', target, url)
+if existing then
+	score = math.min(score, tonumber(existing))
+end
+redis.call('ZADD', target, score, url)
+
+if result == 1 and ARGV[5] == '1' then
+	wake_barber(KEYS[9], ARGV[1])
+end
+return result
+"""
+
+# KEYS: queue, inflight, claimed, ops, rates bucket
+# ARGV: count, lease deadline, doc_type, rates TTL
+# Returns url, enqueue timestamp, "seq op" for each URL claimed
+CLAIM_SCRIPT = """
+local items  = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1, 'WITHSCORES')
+if #items > 0 then
+	redis.call('HINCRBY', KEYS[5], ARGV[3] .. ':dequeued', #items / 2)
+	redis.call('EXPIRE', KEYS[5], ARGV[4])
+end
+local claims = {}
+for i = 1, #items, 2 do
+	redis.call('ZADD', KEYS[2], ARGV[2], items[i])
+	redis.call('HSET', KEYS[3], items[i], items[i+1])
+	table.insert(claims, items[i])
+	table.insert(claims, items[i+1])
+	table.insert(claims, redis.call('HGET', KEYS[4], items[i]) or '0 index')
+end
+if #items > 0 then
+	redis.call('ZREMRANGEBYRANK', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+end
+return claims
+"""
+
+# A URL that's put back without being run only needs to run once, so it goes
+# back in a single lane with the earliest timestamp it's had. That's the lane
+# it came from, unless someone asked for a high priority follow-up while it
+# was in flight; like ENQUEUE, a low priority follow-up doesn't demote it.
+#
+# KEYS: queue, inflight, claimed, followup, other queue, other followup
+# ARGV: now, "1" if the other lane is the high one, urls to put back
+RELEASE_SCRIPT = """
+local released = 0
+for i = 3, #ARGV do
+	local url = ARGV[i]
+	if redis.call('ZREM', KEYS[2], url) == 1 then
+		local score = tonumber(redis.call('HGET', KEYS[3], url))
+		redis.call('HDEL', KEYS[3], url)
+
+		local target, other = KEYS[1], KEYS[5]
+		for _, lane in ipairs({ {KEYS[4], false}, {KEYS[6], ARGV[2] == '1'} }) do
+			local followup = redis.call('ZSCORE', lane[1], url)
+			if followup then
+				redis.call('ZREM', lane[1], url)
+				score = math.min(score, tonumber(followup))
+				if lane[2] then
+					target, other = KEYS[5], KEYS[1]
+				end
+			end
+		end
+
+		-- It shouldn't be waiting anywhere else, but make sure
+		for _, queue in ipairs({ target, other }) do
+			local existing = redis.call('ZSCORE', queue, url)
+			if existing then
+				score = math.min(score, tonumber(existing))
+			end
+		end
+		redis.call('ZREM', other, url)
+		redis.call('ZADD', target, score, url)
+		released = released + 1
+	end
+end
+return released
+"""
+
+# KEYS: inflight, claimed, attempts, errors, queue, followup, other queue, other followup, barber, ops, stats
+# ARGV: url, seq of the op we carried out, now
+ACK_SCRIPT = RELEASE_FOLLOWUP + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+	return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+
+-- Unless someone's asked for something else in the meantime, we're done
+local op = redis.call('HGET', KEYS[10], ARGV[1])
+if op and tonumber(string.match(op, '^%d+')) <= tonumber(ARGV[2]) then
+	redis.call('HDEL', KEYS[10], ARGV[1])
+	if string.match(op, '%a+$') == 'delete' then
+		redis.call('HINCRBY', KEYS[11], 'pending_deletes', -1)
+	end
+end
+release_followup(ARGV[1], KEYS[5], KEYS[6], KEYS[7], KEYS[8], KEYS[9], ARGV[3])
+return 1
+"""
+
+# KEYS: inflight
+# ARGV: url, new lease deadline
+EXTEND_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+	return redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+end
+return -1
+"""
+
+# KEYS: inflight, claimed, retry, attempts, dead, errors, followup, other followup
+# ARGV: url, error, now, max attempts, retry delay, retry delay limit
+# Returns the delay until the next attempt, or -1 if the URL is now dead
+FAIL_SCRIPT = DROP_FOLLOWUP + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+	return -2
+end
+drop_followup(ARGV[1], KEYS[7], KEYS[8])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[6], ARGV[1], ARGV[2])
+
+local attempts = redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+if attempts >= tonumber(ARGV[4]) then
+	redis.call('HDEL', KEYS[4], ARGV[1])
+	redis.call('ZADD', KEYS[5], ARGV[3], ARGV[1])
+	return -1
+end
+
+local delay = math.min(tonumber(ARGV[6]), tonumber(ARGV[5]) * 2 ^ (attempts - 1))
+redis.call('ZADD', KEYS[3], tonumber(ARGV[3]) + delay, ARGV[1])
+return tostring(delay)
+"""
+
+# KEYS: inflight, claimed, retry, followup, other followup
+# ARGV: url, when to try again
+# Like FAIL_SCRIPT, but it doesn't count as an attempt
+PARK_SCRIPT = DROP_FOLLOWUP + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+	return 0
+end
+drop_followup(ARGV[1], KEYS[4], KEYS[5])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+return 1
+"""
+
+# KEYS: barber
+# ARGV: now
+WAKE_SCRIPT = WAKE_BARBER + """
+wake_barber(KEYS[1], ARGV[1])
+"""
+
+# KEYS: queue, retry
+# ARGV: now
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i = 1, #due do
+	redis.call('ZREM', KEYS[2], due[i])
+	if not redis.call('ZSCORE', KEYS[1], due[i]) then
+		redis.call('ZADD', KEYS[1], ARGV[1], due[i])
+	end
+end
+return due
+"""
+
+# KEYS: tombstones, tombstone times
+# ARGV: url, seq of the delete, now
+BURY_SCRIPT = """
+local existing = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+if existing and existing > tonumber(ARGV[2]) then
+	return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+"""
+
+# KEYS: tombstones, tombstone times
+# ARGV: cutoff
+EXHUME_SCRIPT = """
+local old = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i = 1, #old do
+	redis.call('HDEL', KEYS[1], old[i])
+	redis.call('ZREM', KEYS[2], old[i])
+end
+return #old
+"""
+
+# KEYS: queue, dead, attempts, errors
+# ARGV: now, urls to replay
+REPLAY_SCRIPT = """
+local replayed = 0
+for i = 2, #ARGV do
+	if redis.call('ZREM', KEYS[2], ARGV[i]) == 1 then
+		redis.call('HDEL', KEYS[3], ARGV[i])
+		redis.call('HDEL', KEYS[4], ARGV[i])
+		redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+		replayed = replayed + 1
+	end
+end
+return replayed
+"""
+
+
+class UmadQueue(object):
+	def __init__(self, conn, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY, retry_delay_limit=DEFAULT_RETRY_DELAY_LIMIT, tombstone_seconds=DEFAULT_TOMBSTONE_SECONDS):
+		self.conn              = conn
+		self.lease_seconds     = lease_seconds
+		self.max_attempts      = max_attempts
+		self.retry_delay       = retry_delay
+		self.retry_delay_limit = retry_delay_limit
+		self.tombstone_seconds = tombstone_seconds
+
+		self.enqueue_script = conn.register_script(ENQUEUE_SCRIPT)
+		self.claim_script   = conn.register_script(CLAIM_SCRIPT)
+		self.extend_script  = conn.register_script(EXTEND_SCRIPT)
+		self.release_script = conn.register_script(RELEASE_SCRIPT)
+		self.ack_script     = conn.register_script(ACK_SCRIPT)
+		self.fail_script    = conn.register_script(FAIL_SCRIPT)
+		self.park_script    = conn.register_script(PARK_SCRIPT)
+		self.promote_script = conn.register_script(PROMOTE_SCRIPT)
+		self.replay_script  = conn.register_script(REPLAY_SCRIPT)
+		self.bury_script    = conn.register_script(BURY_SCRIPT)
+		self.exhume_script  = conn.register_script(EXHUME_SCRIPT)
+		self.wake_script    = conn.register_script(WAKE_SCRIPT)
+
+	def keys(self, queue_name):
+		return [ queue_name, inflight_key(queue_name), claimed_key(queue_name) ]
+
+	@staticmethod
+	def other_lane(queue_name):
+		"umad_indexing_queue:rt:high  ->  umad_indexing_queue:rt:low"
+		other_lane = [ lane for lane in PRIORITIES if lane != queue_lane(queue_name) ][0]
+		return queue_for(queue_base(queue_name), queue_doc_type(queue_name), other_lane)
+
+	@staticmethod
+	def check_request(op, priority):
+		if op not in OPS:
+			raise ValueError("Operation must be one of {0}, not {1}".format(', '.join(OPS), op))
+		if priority not in PRIORITIES:
+			raise ValueError("Priority must be one of {0}, not {1}".format(', '.join(PRIORITIES), priority))
+
+	def enqueue_keys(self, url, priority):
+		"""Work out which queue the URL goes into, under what name, and the
+		keys that ENQUEUE_SCRIPT needs to put it there. Raises UnroutableURL
+		if it can't go anywhere."""
+		(doc_type, url) = canonicalise(url)
+		queue_name = queue_for(INDEXING_QUEUE, doc_type, priority)
+		other_lane = self.other_lane(queue_name)
+
+		keys = []
+		for q in (queue_name, other_lane):
+			keys += [ q, inflight_key(q), followup_key(q), retry_key(q) ]
+		return (queue_name, url, keys + [WAKEUP_KEY, ops_key(doc_type), OP_SEQ_KEY, stats_key(doc_type)])
+
+	def enqueue(self, url, op=INDEX_OP, priority=HIGH_PRIORITY):
+		"""Ask for a URL to be indexed or deleted (`op` is INDEX_OP or
+		DELETE_OP), superseding anything that was asked for before. It's
+		canonicalised and thrown into the right queue for its doc_type and
+		priority, and a worker is woken up. Returns the name of the queue it
+		went into, or raises UnroutableURL if there isn't one."""
+		self.check_request(op, priority)
+
+		# We're using this idiom to provide what is effectively a "BSPOP"
+		# (blocking pop from a set), on a sorted set, the script pokes the
+		# barber for us if he isn't already due to wake up.
+		# cf. Event Notification: http://redis.io/commands/blpop
+		(queue_name, url, keys) = self.enqueue_keys(url, priority)
+		now = time.time()
+		self.enqueue_script(keys=keys + [rates_bucket(now)], args=[now, url, priority, op, '1', queue_doc_type(queue_name), RATES_TTL])
+
+		return queue_name
+
+	def enqueue_many(self, urls, op=INDEX_OP, priority=HIGH_PRIORITY):
+		"""Like enqueue(), but for a whole lot of URLs at once, in a single
+		transaction with a single wakeup at the end. Returns a dict of
+		queue_name -> number of URLs that went into it. If any of the URLs
+		are unroutable, UnroutableURL is raised and none are enqueued."""
+		self.check_request(op, priority)
+
+		requests = [ self.enqueue_keys(url, priority) for url in urls ]
+
+		now      = time.time()
+		counts   = {}
+		pipeline = self.conn.pipeline(transaction=True)
+		for (queue_name, url, keys) in requests:
+			self.enqueue_script(keys=keys + [rates_bucket(now)], args=[now, url, priority, op, '0', queue_doc_type(queue_name), RATES_TTL], client=pipeline)
+			counts[queue_name] = counts.get(queue_name, 0) + 1
+
+		if counts:
+			self.wake_script(keys=[WAKEUP_KEY], args=[now], client=pipeline)
+			pipeline.execute()
+		return counts
+
+	def depths(self, queue_names):
+		"How many URLs are waiting in each of these queues? One round trip for all of them."
+		pipeline = self.conn.pipeline(transaction=False)
+		for queue_name in queue_names:
+			pipeline.zcard(queue_name)
+		return dict(zip(queue_names, pipeline.execute()))
+
+	def backlog(self, doc_types=DOC_TYPES):
+		"""How far behind are we on each doc_type? Returns a dict of
+		doc_type -> (URLs waiting in either lane, age in seconds of the
+		oldest of them), in one round trip."""
+		pipeline = self.conn.pipeline(transaction=False)
+		for doc_type in doc_types:
+			for lane in PRIORITIES:
+				queue_name = queue_for(INDEXING_QUEUE, doc_type, lane)
+				pipeline.zcard(queue_name)
+				pipeline.zrange(queue_name, 0, 0, withscores=True)
+		results = iter(pipeline.execute())
+
+		now = time.time()
+		backlog = {}
+		for doc_type in doc_types:
+			(depth, age) = (0, 0.0)
+			for lane in PRIORITIES:
+				depth += next(results)
+				oldest = next(results)
+				if oldest:
+					age = max(age, now - oldest[0][1])
+			backlog[doc_type] = (depth, age)
+		return backlog
+
+	def stats(self, doc_types=DOC_TYPES):
+		"""Everything you might want to know about how the queues are doing,
+		for each doc_type and in total, as a dict that's ready to be turned
+		into JSON. It's all from the counters that Redis keeps for us (set
+		sizes, and the head of each set) and the ones the scripts keep (see
+		the top of this file), so it's one cheap round trip however big the
+		queues get.
+
+		Ages and delays are in seconds. The rates are how many URLs were
+		enqueued and dequeued in the last minute and last hour."""
+		now    = time.time()
+		minute = int(now // 60)
+
+		pipeline = self.conn.pipeline(transaction=False)
+		for doc_type in doc_types:
+			for lane in PRIORITIES:
+				queue_name = queue_for(INDEXING_QUEUE, doc_type, lane)
+				# In the same order as `sets` below
+				for key in (queue_name, retry_key(queue_name), dead_key(queue_name)):
+					pipeline.zcard(key)
+					pipeline.zrange(key, 0, 0, withscores=True)
+				pipeline.zcard(inflight_key(queue_name))
+			pipeline.hget(stats_key(doc_type), 'pending_deletes')
+		# Oldest first, the last one is the minute we're in now
+		for m in range(minute - 60, minute + 1):
+			pipeline.hgetall(rates_key(m))
+		pipeline.hgetall(WAKEUP_STATS_KEY)
+		results = list(pipeline.execute())
+		wakeups = results.pop()
+		results = iter(results)
+
+		def earliest(scores):
+			scores = [ score for score in scores if score is not None ]
+			return min(scores) if scores else None
+
+		def age(score):
+			return now - score if score is not None else 0.0
+
+		summary = {}
+		sets    = ('indexing', 'retry', 'dead')
+		for doc_type in doc_types:
+			lanes = {}
+			for lane in PRIORITIES:
+				lanes[lane] = {}
+				for name in sets:
+					depth = next(results)
+					first = next(results)
+					lanes[lane][name] = (depth, first[0][1] if first else None)
+				lanes[lane]['in_flight'] = next(results)
+
+			def combined(name):
+				"Depth of both lanes, and the lowest score of the two"
+				return ( sum( lanes[lane][name][0] for lane in PRIORITIES ), earliest( lanes[lane][name][1] for lane in PRIORITIES ) )
+
+			(waiting, oldest)      = combined('indexing')
+			(retrying, next_retry) = combined('retry')
+			(dead, first_death)    = combined('dead')
+
+			indexing = { 'depth': waiting, 'oldest_age': age(oldest) }
+			for lane in PRIORITIES:
+				(depth, lane_oldest) = lanes[lane]['indexing']
+				indexing[lane] = { 'depth': depth, 'oldest_age': age(lane_oldest) }
+
+			summary[doc_type] = {
+				'indexing':        indexing,
+				'in_flight':       { 'depth': sum( lanes[lane]['in_flight'] for lane in PRIORITIES ) },
+				# Retries are scored by when they're due, not when they went in
+				'retry':           { 'depth': retrying, 'next_due': max(0.0, next_retry - now) if next_retry is not None else None },
+				'dead':            { 'depth': dead, 'oldest_age': age(first_death) },
+				'pending_deletes': int(next(results) or 0),
+			}
+
+		# The minute in progress counts in full, and the bucket that's
+		# sliding out of the window counts for the part that's still in it
+		buckets = list(results)
+		overlap = 1.0 - (now - minute * 60) / 60.0
+		for doc_type in doc_types:
+			for counter in ('enqueued', 'dequeued'):
+				field  = "{0}:{1}".format(doc_type, counter)
+				counts = [ int(bucket.get(field, 0)) for bucket in buckets ]
+				summary[doc_type][counter] = {
+					'last_minute': int(round(counts[-1] + counts[-2] * overlap)),
+					'last_hour':   int(round(sum(counts[1:]) + counts[0] * overlap)),
+				}
+
+		# Add it all up. Depths and counts are summed, ages are the oldest,
+		# and the next retry is the soonest.
+		def total(path, combine=sum, default=0):
+			values = []
+			for doc_type in doc_types:
+				value = summary[doc_type]
+				for step in path:
+					value = value[step]
+				if value is not None:
+					values.append(value)
+			return combine(values) if values else default
+
+		totals = {
+			'indexing':        { 'depth': total(('indexing', 'depth')), 'oldest_age': total(('indexing', 'oldest_age'), max, 0.0) },
+			'in_flight':       { 'depth': total(('in_flight', 'depth')) },
+			'retry':           { 'depth': total(('retry', 'depth')), 'next_due': total(('retry', 'next_due'), min, None) },
+			'dead':            { 'depth': total(('dead', 'depth')), 'oldest_age': total(('dead', 'oldest_age'), max, 0.0) },
+			'pending_deletes': total(('pending_deletes',)),
+		}
+		for lane in PRIORITIES:
+			totals['indexing'][lane] = { 'depth': total(('indexing', lane, 'depth')), 'oldest_age': total(('indexing', lane, 'oldest_age'), max, 0.0) }
+		for counter in ('enqueued', 'dequeued'):
+			totals[counter] = { 'last_minute': total((counter, 'last_minute')), 'last_hour': total((counter, 'last_hour')) }
+
+		# These are counters since forever, graph them as a rate
+		wakeup_stats = dict( (field, int(wakeups.get(field, 0))) for field in ('naps', 'wakeups', 'timeouts', 'spurious') )
+		wakeup_stats.update( (field, float(wakeups.get(field, 0))) for field in ('latency_seconds', 'nap_seconds') )
+
+		return { 'generated': now, 'totals': totals, 'doc_types': summary, 'wakeups': wakeup_stats }
+
+	def claim(self, queue_name, count):
+		"""Atomically lease up to `count` of the oldest URLs in the queue,
+		returning a list of (url, enqueue_timestamp, seq, op) tuples. Hang
+		on to the seq, it's needed to ack the URL."""
+		now      = time.time()
+		doc_type = queue_doc_type(queue_name)
+		keys     = self.keys(queue_name) + [ ops_key(doc_type), rates_bucket(now) ]
+		items    = self.claim_script(keys=keys, args=[count, now + self.lease_seconds, doc_type, RATES_TTL])
+
+		claims = []
+		for i in range(0, len(items), 3):
+			(seq, op) = items[i+2].split(' ', 1)
+			claims.append( (items[i], float(items[i+1]), int(seq), op) )
+		return claims
+
+	def extend(self, queue_name, url):
+		"""Keep our lease on a URL that's taking a while, so it isn't reaped
+		from under us. Returns False if it's too late, and we've lost it."""
+		return self.extend_script(keys=[inflight_key(queue_name)], args=[url, time.time() + self.lease_seconds]) != -1
+
+	def ack(self, queue_name, url, seq):
+		"""We've carried out operation `seq` on the URL, forget about it,
+		unless it was enqueued again while we were busy, in which case it
+		goes back in the queue"""
+		other_lane = self.other_lane(queue_name)
+		doc_type   = queue_doc_type(queue_name)
+		keys = [ inflight_key(queue_name), claimed_key(queue_name), attempts_key(queue_name), errors_key(queue_name),
+			queue_name, followup_key(queue_name), other_lane, followup_key(other_lane), WAKEUP_KEY, ops_key(doc_type), stats_key(doc_type) ]
+		self.ack_script(keys=keys, args=[url, seq, time.time()])
+
+	def bury(self, url, seq):
+		"We've deleted the URL in operation `seq`, leave a tombstone"
+		doc_type = route(url)
+		self.bury_script(keys=[tombstones_key(doc_type), tombstone_times_key(doc_type)], args=[url, seq, time.time()])
+
+	def tombstoned(self, entries):
+		"""Given a list of (url, seq) pairs, return a list of booleans, True
+		for each URL that was deleted after operation `seq` was asked for.
+		Documents for those URLs mustn't be written."""
+		if not entries:
+			return []
+		pipeline = self.conn.pipeline(transaction=False)
+		for (url, seq) in entries:
+			pipeline.hget(tombstones_key(route(url)), url)
+		deleted_at = pipeline.execute()
+		return [ died is not None and int(died) > seq for ((url, seq), died) in zip(entries, deleted_at) ]
+
+	def exhume(self, doc_type):
+		"Clear out tombstones that are old enough not to matter any more, returning how many"
+		cutoff = time.time() - self.tombstone_seconds
+		return self.exhume_script(keys=[tombstones_key(doc_type), tombstone_times_key(doc_type)], args=[cutoff])
+
+	def fail(self, queue_name, url, error):
+		"""Processing the URL didn't work out. Schedule it for another go
+		later, or give up on it if it's had too many goes already.
+
+		Returns the number of seconds until the retry, -1 if the URL has
+		been dead-lettered, or None if we no longer held the lease."""
+		keys = [ inflight_key(queue_name), claimed_key(queue_name), retry_key(queue_name), attempts_key(queue_name), dead_key(queue_name), errors_key(queue_name),
+			followup_key(queue_name), followup_key(self.other_lane(queue_name)) ]
+		# A little jitter stops a herd of URLs that failed together from
+		# all coming back at the same moment
+		retry_delay = self.retry_delay * random.uniform(0.8, 1.2)
+		result = self.fail_script(keys=keys, args=[url, str(error), time.time(), self.max_attempts, retry_delay, self.retry_delay_limit])
+		result = float(result)
+
+		if result == -2:
+			return None
+		return result
+
+	def park(self, queue_name, url, delay):
+		"""We can't process the URL right now through no fault of its own,
+		eg. the upstream is down. Set it aside for `delay` seconds without
+		using up one of its attempts. Returns False if we no longer held the
+		lease."""
+		keys = [ inflight_key(queue_name), claimed_key(queue_name), retry_key(queue_name), followup_key(queue_name), followup_key(self.other_lane(queue_name)) ]
+		return self.park_script(keys=keys, args=[url, time.time() + delay]) == 1
+
+	def promote(self, queue_name):
+		"Move retries that have come due back into the queue, returning the list of them"
+		due = self.promote_script(keys=[queue_name, retry_key(queue_name)], args=[time.time()])
+		if due:
+			self.wake()
+		return due
+
+	def dead_letters(self, queue_name):
+		"List the URLs we've given up on, as (url, time_of_death, last_error) tuples"
+		dead = self.conn.zrange(dead_key(queue_name), 0, -1, withscores=True)
+		if not dead:
+			return []
+		errors = self.conn.hmget(errors_key(queue_name), [ url for (url, died) in dead ])
+		return [ (url, died, error) for ((url, died), error) in zip(dead, errors) ]
+
+	def replay(self, queue_name, urls=None):
+		"Give dead-lettered URLs a fresh set of attempts, all of them if urls is None"
+		if urls is None:
+			urls = self.conn.zrange(dead_key(queue_name), 0, -1)
+		if not urls:
+			return 0
+		replayed = self.replay_script(keys=[queue_name, dead_key(queue_name), attempts_key(queue_name), errors_key(queue_name)], args=[time.time()] + list(urls))
+		if replayed:
+			self.wake()
+		return replayed
+
+	def release(self, queue_name, urls):
+		"Give up our lease on some URLs and put them back where they came from"
+		if not urls:
+			return 0
+		other_lane = self.other_lane(queue_name)
+		keys = self.keys(queue_name) + [ followup_key(queue_name), other_lane, followup_key(other_lane) ]
+		other_is_high = '1' if queue_lane(other_lane) == HIGH_PRIORITY else '0'
+		released = self.release_script(keys=keys, args=[time.time(), other_is_high] + list(urls))
+		if released:
+			self.wake()
+		return released
+
+	def wake(self):
+		"Wake up a napping worker, if one isn't already on its way"
+		self.wake_script(keys=[WAKEUP_KEY], args=[time.time()])
+
+	def nap(self, timeout):
+		"""Wait up to `timeout` seconds for a wakeup. Returns how long ago
+		the wakeup was sent, or None if nobody woke us. It's all counted in
+		WAKEUP_STATS_KEY."""
+		started = time.time()
+		wakeup  = self.conn.brpop(WAKEUP_KEY, timeout=timeout)
+		now     = time.time()
+
+		pipeline = self.conn.pipeline(transaction=False)
+		pipeline.hincrby(WAKEUP_STATS_KEY, 'naps', 1)
+		pipeline.hincrbyfloat(WAKEUP_STATS_KEY, 'nap_seconds', now - started)
+		latency = None
+		if wakeup is None:
+			pipeline.hincrby(WAKEUP_STATS_KEY, 'timeouts', 1)
+		else:
+			try:
+				latency = max(0.0, now - float(wakeup[1]))
+			except ValueError:
+				# Left over from before wakeups had timestamps
+				latency = 0.0
+			pipeline.hincrby(WAKEUP_STATS_KEY, 'wakeups', 1)
+			pipeline.hincrbyfloat(WAKEUP_STATS_KEY, 'latency_seconds', latency)
+		pipeline.execute()
+		return latency
+
+	def spurious_wakeup(self):
+		"We were woken up, but there was nothing for us to do"
+		self.conn.hincrby(WAKEUP_STATS_KEY, 'spurious', 1)
+
+	def drain_legacy_queues(self, chunk_size=LEGACY_DRAIN_CHUNK):
+		"""Move anything still waiting in the old single queues into the
+		queues for their doc_types, so that upgrading doesn't lose it. It all
+		goes into the low lane, it's been waiting this long already. A URL is
+		only removed from the old queue once it's been enqueued, so it's safe
+		for several workers to do this at once; at worst a URL is enqueued
+		twice, which is the same as once.
+
+		Returns a dict of queue_name -> number of URLs moved into it, and a
+		list of the URLs that we threw away because nobody can handle them."""
+		counts     = {}
+		unroutable = []
+		for (legacy_queue, op) in LEGACY_QUEUES:
+			while True:
+				urls = self.conn.zrange(legacy_queue, 0, chunk_size - 1)
+				if not urls:
+					break
+
+				routable = []
+				for url in urls:
+					try:
+						canonicalise(url)
+					except UnroutableURL:
+						unroutable.append(url)
+						continue
+					routable.append(url)
+
+				if routable:
+					for (queue_name, count) in self.enqueue_many(routable, op=op, priority=LOW_PRIORITY).items():
+						counts[queue_name] = counts.get(queue_name, 0) + count
+				self.conn.zrem(legacy_queue, *urls)
+		return (counts, unroutable)
+
+	def forget_wakeups(self):
+		"""Throw away all but one waiting wakeup. The barber list used to get
+		a wakeup for every enqueue, and could grow very long indeed."""
+		self.conn.ltrim(WAKEUP_KEY, -1, -1)
+
+	def reap(self, queue_name):
+		"""Deal with URLs whose lease has expired. The worker probably died
+		while processing them, so it counts as a failed attempt; this stops
+		a URL that reliably kills workers from doing so forever.
+
+		Returns a list of (url, result) pairs, as per fail()."""
+		expired = self.conn.zrangebyscore(inflight_key(queue_name), '-inf', time.time())
+		reaped = []
+		for url in expired:
+			result = self.fail(queue_name, url, "Lease expired")
+			if result is not None:
+				reaped.append( (url, result) )
+		return reaped
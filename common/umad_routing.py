@@ -0,0 +1,79 @@
+import re
+
+# Which doc_type does a URL belong to, and what's its proper name?
+#
+# The worker asks the distillers themselves, through their will_handle()
+# methods (see elasticsearch_backend.determine_doc_type). That means
+# importing every distiller and all their dependencies, which the listener
+# and smykowski can do without, so they use this table of URL prefixes
+# instead. If you add a distiller, or change what its will_handle() accepts,
+# update this table to match.
+#
+# The same document can often be reached by several URLs, eg. rt://123 and
+# https://rt.engineroom.anchor.net.au/Ticket/Display.html?id=123. Each route
+# has a function that turns a URL into the canonical one, the same URL that
+# the distiller will put on the document, so that we only queue it once. It
+# should follow what the distiller's tidy_url() does, and return None for
+# URLs that the distiller would choke on.
+
+
+class UnroutableURL(ValueError): pass
+
+
+def as_is(url):
+	return url
+
+def without_query(url):
+	"Like the wiki distillers' tidy_url(), throw away the query string and fragment"
+	# Question marks aren't disallowed in the fragment identifier (I seem to recall)
+	return url.partition('#')[0].partition('?')[0]
+
+RT_TICKET_URL = re.compile(r'(?:rt://|https://rt\.engineroom\.anchor\.net\.au/Ticket/\w+\.html\?id=)(\d+)')
+def rt_display_url(url):
+	"rt://123 and all the ticket's pages in RT itself are the same ticket"
+	rt_url_match = RT_TICKET_URL.match(url)
+	if rt_url_match is None:
+		return None
+	return 'https://rt.engineroom.anchor.net.au/Ticket/Display.html?id={0}'.format(rt_url_match.group(1))
+
+CUSTOMER_URL = re.compile(r'https://customer\.api\.anchor\.com\.au/customers/\d+$')
+def customer_url(url):
+	return url if CUSTOMER_URL.match(url) else None
+
+
+ROUTES = (
+	( 'customer', ('https://customer.api.anchor.com.au/customers/',), customer_url ),
+	( 'docs',     ('https://docs.anchor.net.au/',), without_query ),
+	( 'domain',   ('https://domains.anchor.com.au/',), as_is ),
+	( 'map',      ('https://map.engineroom.anchor.net.au/',), without_query ),
+	( 'provsys',  ('https://resources.engineroom.anchor.net.au/resources/', 'provsysservers://', 'provsysvlans://'), as_is ),
+	( 'rt',       ('rt://', 'https://rt.engineroom.anchor.net.au/'), rt_display_url ),
+)
+
+# What route() says about URLs that nobody will handle. They can't be
+# enqueued, see canonicalise().
+UNKNOWN_DOC_TYPE = 'unknown'
+
+DOC_TYPES = tuple( doc_type for (doc_type, prefixes, canonical) in ROUTES )
+
+
+def route(url):
+	"Return the doc_type for a URL, or UNKNOWN_DOC_TYPE if we don't recognise it"
+	for (doc_type, prefixes, canonical) in ROUTES:
+		if url.startswith(prefixes):
+			return doc_type
+
+	return UNKNOWN_DOC_TYPE
+
+
+def canonicalise(url):
+	"""Return the (doc_type, canonical_url) for a URL, or raise UnroutableURL
+	if no distiller would know what to do with it"""
+	for (doc_type, prefixes, canonical) in ROUTES:
+		if url.startswith(prefixes):
+			canonical_url = canonical(url)
+			if canonical_url is None:
+				raise UnroutableURL(u"That doesn't look like a {0} URL that we can handle: {1}".format(doc_type, url))
+			return (doc_type, canonical_url)
+
+	raise UnroutableURL(u"We don't have a module that can handle that URL: {0}".format(url))
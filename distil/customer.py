@@ -1,7 +1,6 @@
 import re
 from dateutil.parser import *
 from dateutil.tz import *
-import requests
 
 from distiller import Distiller
 
@@ -78,7 +77,7 @@ class CustomerDistiller(Distiller):
 		except: raise RuntimeError("You must provide Anchor API credentials, please set API_AUTH_USER and API_AUTH_PASS")
 
 		for contact_url in contact_list:
-			contact_response = requests.get(contact_url, auth=api_credentials, verify=True, headers=self.accept_json)
+			contact_response = self.http_get(contact_url, auth=api_credentials, verify=True, headers=self.accept_json)
 
 			try: contact_response.raise_for_status()
 			except: raise RuntimeError("Couldn't get contact from customer API, HTTP error {0}, probably not allowed to view customer".format(contact_response.status_code))
@@ -92,7 +91,7 @@ class CustomerDistiller(Distiller):
 		try: api_credentials = self.auth['anchor_api']
 		except: raise RuntimeError("You must provide Anchor API credentials, please set API_AUTH_USER and API_AUTH_PASS")
 
-		tenancies_response = requests.get(CUSTOMER_TENANCIES_URL, params={'customer_id':customer_id}, auth=api_credentials, verify=True, headers=self.accept_json)
+		tenancies_response = self.http_get(CUSTOMER_TENANCIES_URL, params={'customer_id':customer_id}, auth=api_credentials, verify=True, headers=self.accept_json)
 
 		try: tenancies_response.raise_for_status()
 		except: raise RuntimeError("Couldn't search tenancies in customer API, HTTP error {0}, probably not allowed to view customer".format(tenancies_response.status_code))
@@ -114,7 +113,7 @@ class CustomerDistiller(Distiller):
 			raise ValueError("This URL doesn't match our idea of a customer URL: {0}".format(url))
 		supplied_customer_id = int(customer_url_match.group(1))
 
-		customer_response = requests.get(url, auth=api_credentials, verify=True, headers=self.accept_json)
+		customer_response = self.http_get(url, auth=api_credentials, verify=True, headers=self.accept_json)
 		try: customer_response.raise_for_status()
 		except: raise RuntimeError("Couldn't get customer from API, HTTP error {0}, probably not allowed to view customer".format(customer_response.status_code))
 
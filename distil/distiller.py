@@ -3,6 +3,8 @@ import requests
 from dateutil.parser import *
 from dateutil.tz import *
 
+import upstream
+
 class Distiller(object):
 	def __init__(self, url):
 		self.url         = url
@@ -46,6 +48,18 @@ class Distiller(object):
 		# Delete some other document
 		return requests.delete(self.indexer_url, params={'url':url}, verify=True)
 
+	# Use these instead of requests.get() and friends when talking to an
+	# upstream service, so that many workers don't trample it. See upstream.py
+	def http_get(self, url, **kwargs):
+		return upstream.throttled_request('GET', url, **kwargs)
+
+	def http_head(self, url, **kwargs):
+		return upstream.throttled_request('HEAD', url, **kwargs)
+
+	def upstream_call(self, host, fn, *args, **kwargs):
+		"For upstreams that we talk to through some other library, like provsys"
+		return upstream.limiter().call(host, fn, *args, **kwargs)
+
 	def blobify(self):
 		# Once implemented, blobify is typically a generator, thus
 		# turning self.docs into an iteratori that yields dicts. It's
@@ -1,9 +1,9 @@
-import requests
-from opensrs import OpenSRS
+from opensrs import OpenSRS, OPENSRS_SERVERS
 import json
 import datetime
 
 
+import upstream
 from distiller import Distiller
 from distil.opensrs import OpenSRSHTTPException
 
@@ -14,6 +14,11 @@ class DomainDistiller(Distiller):
 	def will_handle(klass, url):
 		return url.startswith('https://domains.anchor.com.au/')
 
+	@staticmethod
+	def opensrs_timeout(server):
+		# httplib2 only takes a single timeout, not separate connect and read timeouts
+		return max(upstream.timeout_for(upstream.host_of(server)))
+
 	def query(self, action, object, attributes):
 		"""Everything sent to OpenSRS has the following components:
 			action - the name of the action (ie. sw_register, name_suggest, etc)
@@ -30,16 +35,17 @@ class DomainDistiller(Distiller):
 				raise RuntimeError("You must provide OpenHRS credentials, please set OPENHRS_AUTH_USER and OPENHRS_AUTH_KEY")
 			# The OpenSRS library doesn't support arbitary server URLs, like our OpenHRS instance, so we hardcode it here.
 			# There's no test server for OpenHRS, either.
-			opensrs = OpenSRS(username, private_key, server)
+			opensrs = OpenSRS(username, private_key, server, timeout=self.opensrs_timeout(server))
 		else:
 			try:
 				username, private_key = self.auth['opensrs']
 			except:
 				raise RuntimeError("You must provide OpenSRS credentials, please set OPENSRS_AUTH_USER and OPENSRS_AUTH_KEY")
-			opensrs = OpenSRS(username, private_key, test=False)
+			server = OPENSRS_SERVERS['production']
+			opensrs = OpenSRS(username, private_key, server, timeout=self.opensrs_timeout(server))
 
 		if opensrs:
-			post_data = opensrs.post(action, object, attributes)
+			post_data = self.upstream_call(upstream.host_of(opensrs.server), opensrs.post, action, object, attributes)
 			return post_data
 
 	def get_domain_list(self):
@@ -126,7 +132,7 @@ class DomainDistiller(Distiller):
 			except: raise RuntimeError("You must provide Anchor API credentials, please set API_AUTH_USER and API_AUTH_PASS")
 
 			customer_url = 'https://customer.api.anchor.com.au/customers/{}'.format(customer_id)
-			customer_response = requests.get(customer_url, auth=api_credentials, verify=True, headers=self.accept_json)
+			customer_response = self.http_get(customer_url, auth=api_credentials, verify=True, headers=self.accept_json)
 			try:
 				customer_response.raise_for_status()
 				customer = customer_response.json()
@@ -1,6 +1,5 @@
 import os
 import re
-import requests
 from lxml import html
 
 # Plaintext-ify all the junk we get
@@ -35,7 +34,7 @@ class GollumDistiller(Distiller):
 			raise RuntimeError("You must provide Map wiki credentials, please set MAPWIKI_USER and MAPWIKI_PASS")
 
 		# Grab the page
-		response = requests.get(url, auth=wiki_credentials)
+		response = self.http_get(url, auth=wiki_credentials)
 		try:
 			response.raise_for_status()
 		except:
@@ -1,5 +1,4 @@
 import re
-import requests
 from bs4 import BeautifulSoup
 
 WIKIWORD_RE = re.compile(r'([a-z]+)([A-Z])')
@@ -30,14 +29,14 @@ class MoinMapDistiller(Distiller):
 			raise RuntimeError("You must provide Map wiki credentials, please set MAPWIKI_USER and MAPWIKI_PASS")
 
 		# The non-printable version of the page shows valid status codes on redirect, rather than a 200
-		response = requests.head(url, auth=wiki_credentials, verify='AnchorCA.pem', allow_redirects=False)
+		response = self.http_head(url, auth=wiki_credentials, verify='AnchorCA.pem', allow_redirects=False)
 		# Don't index redirects, pages not found, or pages we aren't authorised to view
 		if response.status_code in (301, 403, 404):
 			self.enqueue_deletion()
 			return
 
 		# Once we know the page is valid, grab the printable version of the page
-		response = requests.get(url, auth=wiki_credentials, params={'action':'print'}, verify='AnchorCA.pem')
+		response = self.http_get(url, auth=wiki_credentials, params={'action':'print'}, verify='AnchorCA.pem')
 
 		# An example URL:  https://map.engineroom.anchor.net.au/PoP/SYD1/NetworkPorts
 		#
@@ -61,6 +61,12 @@ class NewtypeDistiller(Distiller):
 	# passed to the `requests` HTTP library (or used in other creative
 	# ways). `self.accept_json` is suitable for passing as the `headers`
 	# parameter to `requests.get` and its siblings.
+	#
+	# When talking to an upstream service over HTTP, use `self.http_get`
+	# and `self.http_head` rather than calling `requests` directly. They
+	# take the same arguments, but are rate-limited per upstream host
+	# across all the workers, so we don't flatten anybody's API. Wrap calls
+	# through other libraries with `self.upstream_call(hostname, fn, ...)`.
 	def blobify(self):
 
 		# This is the starting point for every distiller, take the
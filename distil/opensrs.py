@@ -67,7 +67,7 @@ class OpenSRS(object):
 	username = None
 	private_key = None
 
-	def __init__(self, username, private_key, server=None, test=True):
+	def __init__(self, username, private_key, server=None, test=True, timeout=None):
 		"""
 		Constructor: sets the username, private key and test mode
 
@@ -76,6 +76,7 @@ class OpenSRS(object):
 		private_key - your OpenSRS private key
 		server - your OpenSRS server
 		test - set to False for production operation
+		timeout - seconds to wait on the server before giving up
 		"""
 
 		# if we are using httplib2 that is greater than 0.7
@@ -84,9 +85,9 @@ class OpenSRS(object):
 		# when we connect
 		if httplib2.__version__ > '0.7':
 			import certifi
-			self.H = httplib2.Http(ca_certs=certifi.where())
+			self.H = httplib2.Http(ca_certs=certifi.where(), timeout=timeout)
 		else:
-			self.H = httplib2.Http()
+			self.H = httplib2.Http(timeout=timeout)
 
 		self.username = username
 		self.private_key = private_key
@@ -3,6 +3,8 @@ from provisioningclient import *
 
 from distiller import Distiller
 
+PROVSYS_HOST = 'resources.engineroom.anchor.net.au'
+
 class ProvsysResourceDistiller(Distiller):
 	doc_type = 'provsys'
 
@@ -247,7 +249,7 @@ class ProvsysResourceDistiller(Distiller):
 		resource_id = self.url.replace('https://resources.engineroom.anchor.net.au/resources/', '')
 		result = Resource.get(resource_id)
 		try:
-			result.load()
+			self.upstream_call(PROVSYS_HOST, result.load)
 		except lib.provisioningobject.HTTPError as e:
 			# Optional action, I don't think we'll ever actually have a resource disappear
 			#self.enqueue_deletion()
@@ -279,7 +281,7 @@ class ProvsysResourceDistiller(Distiller):
 		if resource.type.id in chassis_type_ids:
 			self.debug("Resource {0} is a chassis, will find OSes contained within".format(resource_id))
 			this_chassis = resource
-			child_oses = Resource.search(supertype="Generic OS install", container=this_chassis)
+			child_oses = self.upstream_call(PROVSYS_HOST, Resource.search, supertype="Generic OS install", container=this_chassis)
 			for child_os in child_oses:
 				self.debug("Enqueueing resource {0} for indexing".format(child_os.id))
 				oses_to_index.append(child_os)
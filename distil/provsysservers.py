@@ -1,6 +1,6 @@
 from provisioningclient import *
 
-from provsysresource import ProvsysResourceDistiller
+from provsysresource import ProvsysResourceDistiller, PROVSYS_HOST
 
 from distiller import Distiller
 
@@ -19,7 +19,7 @@ class ProvsysServersDistiller(Distiller):
 		server.apikey       = "umad_distiller"
 		server.ca_cert_file = None
 
-		results = Resource.search(supertype="Generic OS install")
+		results = self.upstream_call(PROVSYS_HOST, Resource.search, supertype="Generic OS install")
 		if not results:
 			return
 
@@ -3,7 +3,6 @@ from operator import itemgetter
 from itertools import chain
 from dateutil.parser import *
 from dateutil.tz import *
-import requests
 import redis
 
 TICKET_URL_TEMPLATE = 'https://ticket.api.anchor.com.au/ticket/{0}'.format
@@ -131,7 +130,7 @@ class RtTicketDistiller(Distiller):
 		ticket_url   = self.ticket_url
 
 		# Get ticket from API
-		ticket_response = requests.get(ticket_url, auth=api_credentials, verify=True, headers=self.accept_json)
+		ticket_response = self.http_get(ticket_url, auth=api_credentials, verify=True, headers=self.accept_json)
 		try:
 			ticket_response.raise_for_status()
 		except:
@@ -189,7 +188,7 @@ class RtTicketDistiller(Distiller):
 		if customer_id:
 			if cn_get(customer_id) is None:
 				# We need to retrieve it from the customer API
-				customer_response = requests.get(customer_url, auth=api_credentials, verify=True, headers=self.accept_json)
+				customer_response = self.http_get(customer_url, auth=api_credentials, verify=True, headers=self.accept_json)
 				if customer_response.status_code != 200:
 					retrieved_name = '__NOT_FOUND__'
 				else:
@@ -211,7 +210,7 @@ class RtTicketDistiller(Distiller):
 		ticket_lastupdated = ticket_lastupdated.astimezone(tzutc())
 
 		# Get associated messages from API
-		messages_response  = requests.get(TICKET_MESSAGE_URL_BASE, params={'ticket_url': self.ticket_url}, auth=api_credentials, verify=True, headers=self.accept_json)
+		messages_response  = self.http_get(TICKET_MESSAGE_URL_BASE, params={'ticket_url': self.ticket_url}, auth=api_credentials, verify=True, headers=self.accept_json)
 		try:
 			messages_response.raise_for_status()
 		except:
@@ -0,0 +1,302 @@
+import os
+import sys
+import time
+import socket
+from urlparse import urlparse
+
+import redis
+import requests
+
+# Every upstream service that the distillers talk to gets a token bucket, kept
+# in Redis so that all the workers on all the hosts share it. Before making a
+# request, a distiller takes a token from the bucket for that host, waiting
+# if there aren't any.
+#
+# The refill rate adapts to how the upstream is coping (AIMD, like TCP
+# congestion control). Each healthy response nudges the rate up a little.
+# A 429, a 5xx, a connection failure, or a response slower than
+# slow_seconds halves it. The rate is halved at most once per cooldown, so
+# a burst of failures from requests that were already in flight doesn't
+# crater it.
+#
+# If an upstream is properly down, slowing down isn't enough. After
+# trip_after failures in a row (connection trouble, timeouts, 429s and 5xx's,
+# but not mere slowness) its circuit breaker opens, and for open_seconds
+# every call to it fails immediately with UpstreamUnavailable. The indexing
+# worker parks those URLs in their queue instead of counting them as failed
+# attempts. Once open_seconds is up, one request is let through as a probe;
+# if it works the breaker closes again, otherwise it stays open for another
+# open_seconds.
+#
+# For host H we keep:
+#   umad_upstream:H   HASH   tokens, stamp (last refill), rate, backed_off (last decrease)
+#   umad_breaker:H    HASH   state (closed/open/half_open), failures (in a row), until, trips, changed
+
+DEFAULT_LIMITS = {
+	'rate':         5.0,  # requests/sec to start with
+	'min_rate':     0.2,
+	'max_rate':     50.0,
+	'burst':        10,   # bucket size
+	'increase':     0.1,  # requests/sec added per healthy response
+	'decrease':     0.5,  # rate multiplier on trouble
+	'cooldown':     5.0,  # seconds between decreases
+	'slow_seconds': 5.0,  # responses slower than this count as trouble
+	'connect_timeout': 5.0,
+	'read_timeout':    30.0,
+	'trip_after':      5,    # failures in a row before the breaker opens
+	'open_seconds':    60.0, # how long the breaker stays open before a probe
+}
+
+# Overrides for particular upstreams, keyed by hostname
+UPSTREAM_LIMITS = {
+	'ticket.api.anchor.com.au':            { 'rate': 5.0, 'max_rate': 20.0 },
+	'customer.api.anchor.com.au':          { 'rate': 5.0, 'max_rate': 20.0 },
+	'resources.engineroom.anchor.net.au':  { 'rate': 5.0, 'max_rate': 20.0 },
+	'docs.anchor.net.au':                  { 'rate': 10.0 },
+	'map.engineroom.anchor.net.au':        { 'rate': 10.0 },
+	'rr-n1-tor.opensrs.net':               { 'rate': 2.0, 'max_rate': 5.0, 'read_timeout': 60.0 },
+	'domains.anchor.com.au':               { 'rate': 2.0, 'max_rate': 5.0, 'read_timeout': 60.0 },
+}
+
+# Exceptions that mean the upstream is struggling, rather than that we asked
+# for something silly
+OVERLOAD_EXCEPTIONS = (socket.error, socket.timeout, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+bucket_key  = "umad_upstream:{0}".format
+breaker_key = "umad_breaker:{0}".format
+
+
+class UpstreamUnavailable(Exception):
+	"The upstream's circuit breaker is open, try again in retry_in seconds"
+	def __init__(self, host, retry_in):
+		Exception.__init__(self, "{0} is unavailable, circuit breaker is open for another {1:.0f} seconds".format(host, retry_in))
+		self.host     = host
+		self.retry_in = retry_in
+
+
+# KEYS: bucket
+# ARGV: now, initial rate, burst
+# Returns how long to wait before trying again, 0 if we got a token
+ACQUIRE_SCRIPT = """
+local now    = tonumber(ARGV[1])
+local burst  = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp', 'rate')
+local tokens = tonumber(bucket[1]) or burst
+local stamp  = tonumber(bucket[2]) or now
+local rate   = tonumber(bucket[3]) or tonumber(ARGV[2])
+
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+else
+	wait = (1 - tokens) / rate
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(wait)
+"""
+
+# KEYS: bucket
+# ARGV: now, healthy (1 or 0), initial rate, min rate, max rate, increase, decrease, cooldown
+# Returns the new rate
+ADJUST_SCRIPT = """
+local now  = tonumber(ARGV[1])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[3])
+
+if ARGV[2] == '1' then
+	rate = math.min(tonumber(ARGV[5]), rate + tonumber(ARGV[6]))
+else
+	local backed_off = tonumber(redis.call('HGET', KEYS[1], 'backed_off')) or 0
+	if now - backed_off >= tonumber(ARGV[8]) then
+		rate = math.max(tonumber(ARGV[4]), rate * tonumber(ARGV[7]))
+		redis.call('HSET', KEYS[1], 'backed_off', now)
+	end
+end
+
+redis.call('HSET', KEYS[1], 'rate', rate)
+return tostring(rate)
+"""
+
+
+# KEYS: breaker
+# ARGV: now, open seconds
+# Returns how long until the breaker might close, 0 if we may go ahead
+BREAKER_CHECK_SCRIPT = """
+local now     = tonumber(ARGV[1])
+local breaker = redis.call('HMGET', KEYS[1], 'state', 'until')
+local state   = breaker[1]
+local reopen  = tonumber(breaker[2]) or 0
+
+if state ~= 'open' and state ~= 'half_open' then
+	return '0'
+end
+if now < reopen then
+	return tostring(reopen - now)
+end
+
+-- Time's up. The caller gets to be the probe, and everyone else keeps
+-- waiting until it reports back (or doesn't, in which case we try another)
+redis.call('HMSET', KEYS[1], 'state', 'half_open', 'until', now + tonumber(ARGV[2]), 'changed', now)
+return '0'
+"""
+
+# KEYS: breaker
+# ARGV: now, ok (1 or 0), trip after, open seconds
+# Returns the state of the breaker
+BREAKER_RECORD_SCRIPT = """
+local now   = tonumber(ARGV[1])
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+
+if ARGV[2] == '1' then
+	if state ~= 'closed' then
+		redis.call('HMSET', KEYS[1], 'state', 'closed', 'changed', now)
+	end
+	redis.call('HSET', KEYS[1], 'failures', 0)
+	return 'closed'
+end
+
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if state == 'half_open' or (state == 'closed' and failures >= tonumber(ARGV[3])) then
+	redis.call('HMSET', KEYS[1], 'state', 'open', 'until', now + tonumber(ARGV[4]), 'changed', now)
+	redis.call('HINCRBY', KEYS[1], 'trips', 1)
+	return 'tripped'
+end
+if state == 'closed' then
+	redis.call('HSET', KEYS[1], 'state', 'closed')
+end
+return state
+"""
+
+
+def limits_for(host):
+	limits = dict(DEFAULT_LIMITS)
+	limits.update(UPSTREAM_LIMITS.get(host, {}))
+	return limits
+
+
+class UpstreamLimiter(object):
+	def __init__(self, conn):
+		self.conn           = conn
+		self.acquire_script = conn.register_script(ACQUIRE_SCRIPT)
+		self.adjust_script  = conn.register_script(ADJUST_SCRIPT)
+		self.check_script   = conn.register_script(BREAKER_CHECK_SCRIPT)
+		self.record_script  = conn.register_script(BREAKER_RECORD_SCRIPT)
+		self.complained     = False
+
+	def complain(self, e):
+		# Rate limiting is a nicety, we fail open if Redis isn't around. But
+		# say so, once.
+		if not self.complained:
+			sys.stderr.write("Upstream rate limiting is disabled, couldn't talk to Redis: {0}\n".format(e))
+			self.complained = True
+
+	def acquire(self, host):
+		"Block until we're allowed to send a request to this host"
+		limits = limits_for(host)
+		while True:
+			try:
+				wait = float(self.acquire_script(keys=[bucket_key(host)], args=[time.time(), limits['rate'], limits['burst']]))
+			except redis.exceptions.RedisError as e:
+				self.complain(e)
+				return
+			if wait <= 0:
+				return
+			time.sleep(min(wait, 1.0))
+
+	def report(self, host, healthy):
+		"Tell the limiter how a request went, so it can adjust the rate"
+		limits = limits_for(host)
+		try:
+			self.adjust_script(keys=[bucket_key(host)], args=[
+				time.time(), '1' if healthy else '0',
+				limits['rate'], limits['min_rate'], limits['max_rate'],
+				limits['increase'], limits['decrease'], limits['cooldown'] ])
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+
+	def check_breaker(self, host):
+		"Raise UpstreamUnavailable if the host's circuit breaker is open"
+		try:
+			retry_in = float(self.check_script(keys=[breaker_key(host)], args=[time.time(), limits_for(host)['open_seconds']]))
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+			return
+		if retry_in > 0:
+			raise UpstreamUnavailable(host, retry_in)
+
+	def record(self, host, ok):
+		"Tell the circuit breaker whether the upstream is working at all"
+		limits = limits_for(host)
+		try:
+			state = self.record_script(keys=[breaker_key(host)], args=[time.time(), '1' if ok else '0', limits['trip_after'], limits['open_seconds']])
+		except redis.exceptions.RedisError as e:
+			self.complain(e)
+			return
+		if state == 'tripped':
+			sys.stderr.write("Circuit breaker for {0} is open, leaving it alone for {1:.0f} seconds\n".format(host, limits['open_seconds']))
+
+	def call(self, host, fn, *args, **kwargs):
+		"""Call fn(*args, **kwargs), which talks to `host`, once we've got a
+		token, and then report how it went. If fn returns something with a
+		status_code, like a requests.Response, that's taken into account.
+
+		Raises UpstreamUnavailable without calling fn if the host's circuit
+		breaker is open."""
+		self.check_breaker(host)
+		self.acquire(host)
+
+		started = time.time()
+		try:
+			result = fn(*args, **kwargs)
+		except OVERLOAD_EXCEPTIONS:
+			self.report(host, False)
+			self.record(host, False)
+			raise
+		elapsed = time.time() - started
+
+		status_code = getattr(result, 'status_code', None)
+		overloaded  = status_code is not None and (status_code == 429 or status_code >= 500)
+		slow        = elapsed > limits_for(host)['slow_seconds']
+		self.report(host, not (overloaded or slow))
+		self.record(host, not overloaded)
+
+		return result
+
+	def breakers(self):
+		"The state of every circuit breaker we know about, as a dict of dicts keyed by host"
+		states = {}
+		for key in self.conn.scan_iter(match=breaker_key('*')):
+			states[key.split(':', 1)[1]] = self.conn.hgetall(key)
+		return states
+
+
+_limiter = None
+
+def limiter():
+	"The limiter shared by all the distillers in this process"
+	global _limiter
+	if _limiter is None:
+		redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
+		redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
+		_limiter = UpstreamLimiter(redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0))
+	return _limiter
+
+
+def host_of(url):
+	return urlparse(url).hostname
+
+
+def timeout_for(host):
+	"How long to wait on this host, in the form that requests wants"
+	limits = limits_for(host)
+	return (limits['connect_timeout'], limits['read_timeout'])
+
+
+def throttled_request(method, url, **kwargs):
+	"""A drop-in for requests.request() that plays nicely with the upstream,
+	and doesn't wait on it forever"""
+	host = host_of(url)
+	kwargs.setdefault('timeout', timeout_for(host))
+	return limiter().call(host, requests.request, method, url, **kwargs)
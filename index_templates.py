@@ -0,0 +1 @@
+common/index_templates.py
\ No newline at end of file
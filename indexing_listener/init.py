@@ -1,11 +1,15 @@
 import sys
 import os
 import time
+import json
 from optparse import OptionParser
 
 import redis
 
-from bottle import route, request, run, default_app, abort
+from bottle import route, request, response, run, default_app, abort, BaseRequest, HTTPError
+
+from umad_queue import UmadQueue, INDEX_OP, DELETE_OP, HIGH_PRIORITY, LOW_PRIORITY, PRIORITIES
+from umad_routing import canonicalise, UnroutableURL
 
 
 # XXX: maybe these should be to stdout instead of stderr, I dunno
@@ -24,6 +28,65 @@ debug("Debug logging is enabled")
 redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
 redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
 teh_redis = redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0)
+work_queue = UmadQueue(teh_redis)
+
+# Bulk enqueues can be a few MB of URLs, bottle only allows 100KB by default
+BaseRequest.MEMFILE_MAX = int(os.environ.get('UMAD_INDEXING_LISTENER_MAX_BODY', 16 * 1024 * 1024))
+
+BULK_ACTIONS = { 'index': INDEX_OP, 'delete': DELETE_OP }
+
+# Admission control. When a doc_type has more than MAX_DEPTH URLs waiting,
+# or the oldest has been waiting longer than MAX_AGE seconds, low priority
+# and bulk enqueues for it are turned away with a 429, and asked to come
+# back after RETRY_AFTER seconds. Backfills slow down to match what the
+# workers can do, rather than burying interactive updates. High priority
+# single URLs are always let in.
+ADMIT_MAX_DEPTH = int(os.environ.get('UMAD_INDEXING_LISTENER_MAX_DEPTH', 50000))
+ADMIT_MAX_AGE   = float(os.environ.get('UMAD_INDEXING_LISTENER_MAX_AGE', 900))
+RETRY_AFTER     = int(os.environ.get('UMAD_INDEXING_LISTENER_RETRY_AFTER', 60))
+# Don't hit Redis on every request to find out
+BACKLOG_CACHE_SECONDS = float(os.environ.get('UMAD_INDEXING_LISTENER_BACKLOG_CACHE_SECONDS', 5))
+
+class Backlog(object):
+	"The state of the queues, as of a few seconds ago"
+
+	def __init__(self, work_queue, max_depth=ADMIT_MAX_DEPTH, max_age=ADMIT_MAX_AGE, cache_seconds=BACKLOG_CACHE_SECONDS):
+		self.work_queue    = work_queue
+		self.max_depth     = max_depth
+		self.max_age       = max_age
+		self.cache_seconds = cache_seconds
+		self.backlog       = {}
+		self.fetched       = 0
+
+	def current(self):
+		if time.time() - self.fetched > self.cache_seconds:
+			try:
+				self.backlog = self.work_queue.backlog()
+			except redis.exceptions.RedisError as e:
+				# We'll find out soon enough when we try to enqueue
+				debug(u"Couldn't check the backlog, letting everything in: {0}".format(e))
+				self.backlog = {}
+			self.fetched = time.time()
+		return self.backlog
+
+	def overloaded(self, doc_types):
+		"Which of these doc_types are too far behind to take on more bulk work?"
+		backlog = self.current()
+		busy = []
+		for doc_type in sorted(set(doc_types)):
+			(depth, age) = backlog.get(doc_type, (0, 0.0))
+			if depth > self.max_depth or age > self.max_age:
+				busy.append( (doc_type, depth, age) )
+		return busy
+
+backlog = Backlog(work_queue)
+
+def admit(doc_types):
+	"Turn the request away with a 429 if any of these doc_types are backed up"
+	busy = backlog.overloaded(doc_types)
+	if busy:
+		details = ', '.join( "{0} has {1} URLs waiting, the oldest for {2:.0f}sec".format(*b) for b in busy )
+		raise HTTPError(429, "Too busy, try again in {0} seconds: {1}".format(RETRY_AFTER, details), headers={'Retry-After': str(RETRY_AFTER)})
 
 
 
@@ -36,24 +99,35 @@ def index():
 		abort(400, "Y U DO DIS? I can't {0} something unless you give me 'url' as a query parameter".format(human_method))
 	debug(u"URL to index: %s" % url)
 
+	# Interactive updates are high priority, bulk tools should ask for low
+	priority = request.query.priority or HIGH_PRIORITY
+	if priority not in PRIORITIES:
+		abort(400, "I don't know what priority '{0}' is, try one of: {1}".format(priority, ', '.join(PRIORITIES)))
+
 	human_action = { 'GET':"indexing", 'DELETE':"deletion" }.get(request.method, 'something-something-action')
 
+	# Turn away anything the worker wouldn't know what to do with, and
+	# settle on one name for each document
+	try:
+		(doc_type, url) = canonicalise(url)
+	except UnroutableURL as e:
+		abort(400, unicode(e))
+
+	if priority != HIGH_PRIORITY:
+		admit([doc_type])
+
 	try:
 		if request.method == 'DELETE':
-			queue_name  = 'umad_deletion_queue'
+			op = DELETE_OP
 		else:
-			queue_name  = 'umad_indexing_queue'
+			op = INDEX_OP
 
-		# Throw URLs into Redis. We're using this idiom to provide what is
-		# effectively a "BSPOP" (blocking pop from a set), on a sorted set.
-		# cf. Event Notification: http://redis.io/commands/blpop
+		# Throw URLs into Redis, in the queue for their doc_type. The
+		# latest op for a URL wins, whether it's an index or a delete.
 		# I-It's not like I wanted the set to be sorted or anything! I'm
 		# keeping input timestamps, just so you know.
-		pipeline = teh_redis.pipeline()
-		pipeline.zadd(queue_name, time.time(), url)
-		pipeline.lpush('barber', 'dummy_value')
-		pipeline.execute() # will return something like:   [ {0|1}, num_dummies ]
-		debug(u"Successful insertion of {0} for {1}".format(url, human_action))
+		queue_name = work_queue.enqueue(url, op, priority)
+		debug(u"Successful insertion of {0} into {1} for {2}".format(url, queue_name, human_action))
 	except Exception as e:
 		abort(500, "Something went boom while inserting {0}: {1}".format(url, e))
 
@@ -61,6 +135,86 @@ def index():
 	return u"Success, enqueued URL for {0}: '{1}'".format(human_action, url)
 
 
+@route('/bulk', method='POST')
+def bulk():
+	"""Enqueue lots of URLs in one go, for backfills and the like. The body
+	is either one URL per line, or a JSON list of URLs. `action` (index or
+	delete) and `priority` are query parameters. A JSON body can also be an
+	object, like {"urls": [...], "action": "delete", "priority": "high"}.
+
+	Bulk enqueues are low priority unless you say otherwise."""
+	action   = request.query.action
+	priority = request.query.priority
+
+	try:
+		body = request.json
+	except ValueError as e:
+		abort(400, "That's not valid JSON: {0}".format(e))
+
+	if isinstance(body, dict):
+		urls     = body.get('urls')
+		action   = body.get('action', action)
+		priority = body.get('priority', priority)
+	elif body is not None:
+		urls = body
+	else:
+		urls = request.body.read().decode('utf8').splitlines()
+
+	if not isinstance(urls, list):
+		abort(400, "Y U DO DIS? I need a list of URLs, one per line or as JSON")
+	not_urls = [ url for url in urls if not isinstance(url, basestring) ]
+	if not_urls:
+		abort(400, u"Nothing enqueued, {0} of those aren't URLs, eg.: {1}".format(len(not_urls), u' '.join( json.dumps(x) for x in not_urls[:10] )))
+	urls = [ url.strip() for url in urls if url.strip() ]
+	if not urls:
+		abort(400, "Y U DO DIS? I can't enqueue anything unless you give me some URLs")
+
+	action = action or 'index'
+	if not isinstance(action, basestring) or action not in BULK_ACTIONS:
+		abort(400, u"I don't know how to {0} something, try one of: {1}".format(json.dumps(action), ', '.join(sorted(BULK_ACTIONS))))
+	priority = priority or LOW_PRIORITY
+	if not isinstance(priority, basestring) or priority not in PRIORITIES:
+		abort(400, u"I don't know what priority {0} is, try one of: {1}".format(json.dumps(priority), ', '.join(PRIORITIES)))
+
+	# It's all or nothing, so the caller doesn't have to work out which ones made it
+	unroutable = []
+	doc_types  = set()
+	for url in urls:
+		try:
+			doc_types.add(canonicalise(url)[0])
+		except UnroutableURL as e:
+			unroutable.append(url)
+	if unroutable:
+		abort(400, u"Nothing enqueued, we can't handle {0} of those URLs, eg.: {1}".format(len(unroutable), u' '.join(unroutable[:10])))
+
+	# Bulk work waits its turn, whatever priority it asked for
+	admit(doc_types)
+
+	try:
+		# One transaction and one wakeup for the lot
+		counts = work_queue.enqueue_many(urls, BULK_ACTIONS[action], priority)
+		debug(u"Successful bulk insertion of {0} URLs for {1}".format(len(urls), action))
+	except Exception as e:
+		abort(500, "Something went boom while inserting {0} URLs: {1}".format(len(urls), e))
+
+	response.content_type = 'text/plain; charset=utf-8'
+	lines = [ u"Success, enqueued {0} URLs for {1}".format(len(urls), action) ]
+	lines += [ u"{0}\t{1}".format(queue_name, counts[queue_name]) for queue_name in sorted(counts) ]
+	return u'\n'.join(lines) + u'\n'
+
+
+
+@route('/stats', method='GET')
+def stats():
+	"""How the queues are doing, as JSON: depth and age of the oldest URL
+	for each set, in-flight URLs, pending deletes, and how many URLs were
+	enqueued and dequeued in the last minute and hour. Broken down by
+	doc_type, with totals."""
+	try:
+		return work_queue.stats()
+	except redis.exceptions.RedisError as e:
+		abort(503, "Couldn't get the queue stats out of Redis: {0}".format(e))
+
 
 # For encapsulating in a WSGI container
 application = default_app()
@@ -1,9 +1,19 @@
 import sys
 import os
+import time
+import errno
+import signal
+import socket
+import threading
+import Queue
+from optparse import OptionParser
 
 import redis
 
 from elasticsearch_backend import *
+from umad_queue import UmadQueue, INDEXING_QUEUE, DELETE_OP, HIGH_PRIORITY, LOW_PRIORITY, queue_for, queue_doc_type, all_queues
+from umad_routing import DOC_TYPES
+from distil.upstream import UpstreamUnavailable
 
 
 # XXX: maybe these should be to stdout instead of stderr, I dunno
@@ -21,13 +31,257 @@ DEBUG = bool(os.environ.get('UMAD_INDEXING_WORKER_DEBUG') == "True")
 PID_PREFIX = '[pid {0}] '.format(os.getpid())
 debug("Debug logging is enabled")
 
+# How many URLs to pop off a queue per round trip to Redis
+BATCH_SIZE = int(os.environ.get('UMAD_INDEXING_WORKER_BATCH_SIZE', 20))
+# Documents are held back and sent to ES in bulk, flushed when we have this
+# many of them, or when the oldest has been waiting this long.
+FLUSH_DOCS    = int(os.environ.get('UMAD_INDEXING_WORKER_FLUSH_DOCS', 200))
+FLUSH_SECONDS = float(os.environ.get('UMAD_INDEXING_WORKER_FLUSH_SECONDS', 5))
+# In supervisor mode, fork this many workers. Each one is recycled after
+# processing MAX_JOBS URLs, to put a bound on memory growth. 0 means forever.
+NUM_PROCESSES = int(os.environ.get('UMAD_INDEXING_WORKER_PROCESSES', 1))
+MAX_JOBS      = int(os.environ.get('UMAD_INDEXING_WORKER_MAX_JOBS', 0))
+# Don't nap for longer than this, so we notice that we've been asked to stop
+NAP_SECONDS   = int(os.environ.get('UMAD_INDEXING_WORKER_NAP_SECONDS', 5))
+# Inside each worker, URLs are fetched and distilled by FETCHERS threads, and
+# documents are written to ES by SINKS threads. The stages are joined by
+# bounded queues, so a slow ES cluster throttles fetching instead of piling
+# up documents in memory.
+FETCHERS    = int(os.environ.get('UMAD_INDEXING_WORKER_FETCHERS', 4))
+SINKS       = int(os.environ.get('UMAD_INDEXING_WORKER_SINKS', 1))
+URL_BACKLOG = int(os.environ.get('UMAD_INDEXING_WORKER_URL_BACKLOG', BATCH_SIZE))
+DOC_BACKLOG = int(os.environ.get('UMAD_INDEXING_WORKER_DOC_BACKLOG', FLUSH_DOCS * 2))
+# A worker's claim on a URL lapses after this long, and the reaper will hand
+# it to someone else. The reaper runs every REAP_INTERVAL seconds.
+LEASE_SECONDS = int(os.environ.get('UMAD_INDEXING_WORKER_LEASE_SECONDS', 600))
+REAP_INTERVAL = int(os.environ.get('UMAD_INDEXING_WORKER_REAP_INTERVAL', 30))
+# Failed URLs are retried with exponential backoff, starting at RETRY_DELAY
+# seconds and capped at RETRY_DELAY_LIMIT. After MAX_ATTEMPTS they're put
+# in a dead-letter set; see util_dead_letters.py.
+MAX_ATTEMPTS      = int(os.environ.get('UMAD_INDEXING_WORKER_MAX_ATTEMPTS', 5))
+RETRY_DELAY       = float(os.environ.get('UMAD_INDEXING_WORKER_RETRY_DELAY', 30))
+RETRY_DELAY_LIMIT = float(os.environ.get('UMAD_INDEXING_WORKER_RETRY_DELAY_LIMIT', 3600))
+# Deleted URLs leave a tombstone behind, so that documents from an older
+# index run can't resurrect them. Keep them for this long.
+TOMBSTONE_SECONDS = int(os.environ.get('UMAD_INDEXING_WORKER_TOMBSTONE_SECONDS', 86400))
+# Crashing children get restarted, but not in a tight loop
+RESPAWN_DELAY = float(os.environ.get('UMAD_INDEXING_WORKER_RESPAWN_DELAY', 1))
+# Distillers get per-upstream timeouts from distil/upstream.py, but some
+# client libraries (like provsys) don't let you set one. This is the
+# backstop, so that a hung upstream can't wedge a fetcher forever.
+SOCKET_TIMEOUT = float(os.environ.get('UMAD_INDEXING_WORKER_SOCKET_TIMEOUT', 120))
 
 
-def index(url):
+def parse_per_doc_type(setting, default):
+	"Turn something like 'rt:1,docs:4' into a dict covering every doc_type"
+	values = dict( (doc_type, default) for doc_type in DOC_TYPES )
+	for pair in (setting or '').split(','):
+		if not pair.strip():
+			continue
+		(doc_type, value) = pair.split(':')
+		values[doc_type.strip()] = int(value)
+	return values
+
+# Each doc_type has its own queue. Queues get a share of our attention in
+# proportion to their weight, and each doc_type can be limited to a number of
+# URLs in flight at once, per worker process. Eg. to stop RT tickets, which
+# need several slow API calls apiece, from hogging all the fetchers:
+#   UMAD_INDEXING_WORKER_WEIGHTS="docs:4,map:4,rt:1"
+#   UMAD_INDEXING_WORKER_CONCURRENCY="rt:2"
+DOC_TYPE_WEIGHTS     = parse_per_doc_type(os.environ.get('UMAD_INDEXING_WORKER_WEIGHTS'),     1)
+DOC_TYPE_CONCURRENCY = parse_per_doc_type(os.environ.get('UMAD_INDEXING_WORKER_CONCURRENCY'), FETCHERS + URL_BACKLOG)
+# The high-priority lane is always served first, but so that a steady
+# trickle of interactive updates can't starve bulk backfills completely, the
+# low lane gets one batch in every LOW_LANE_EVERY when both have work.
+LOW_LANE_EVERY = int(os.environ.get('UMAD_INDEXING_WORKER_LOW_LANE_EVERY', 10))
+# When every doc_type with work waiting is at its concurrency limit, wait
+# this long before checking again
+BUSY_WAIT_SECONDS = float(os.environ.get('UMAD_INDEXING_WORKER_BUSY_WAIT_SECONDS', 0.5))
+
+# Set by SIGTERM, we finish what we're doing and bail out cleanly
+STOPPING = False
+
+
+class Job(object):
+	"""A claimed URL, the operation to carry out on it, and the documents
+	it's produced that are still on their way to ES. A URL is only acked
+	once it's been distilled and every one of its documents has been
+	written, otherwise we leave the lease to fail it, so it'll be retried
+	later."""
+
+	def __init__(self, work_queue, queue_name, url, seq, op, on_distilled=None, on_finished=None):
+		self.work_queue = work_queue
+		self.queue_name = queue_name
+		self.doc_type   = queue_doc_type(queue_name)
+		self.url        = url
+		self.seq        = seq
+		self.op         = op
+		self.on_distilled = on_distilled
+		self.on_finished  = on_finished
+		self.pending    = 0
+		self.distilled  = False
+		self.failed     = False
+		self.error      = None
+		self.parked     = None
+		self.finished   = False
+		self.extended   = time.time()
+		self.lock       = threading.Lock()
+
+	def doc_emitted(self):
+		with self.lock:
+			self.pending += 1
+
+		# Big backfills can keep going for longer than the lease
+		if time.time() - self.extended > self.work_queue.lease_seconds / 4:
+			self.extended = time.time()
+			self.work_queue.extend(self.queue_name, self.url)
+
+	def doc_written(self, success, error=None):
+		with self.lock:
+			self.pending -= 1
+			self.note_failure(success, error)
+		self.maybe_finish()
+
+	def distil_done(self, success, error=None):
+		with self.lock:
+			self.distilled = True
+			self.note_failure(success, error)
+		if self.on_distilled is not None:
+			self.on_distilled(self)
+		self.maybe_finish()
+
+	def park(self, retry_in):
+		"The upstream is down, so we gave up without trying. Put the URL aside for a bit."
+		with self.lock:
+			self.distilled = True
+			self.parked    = retry_in
+		if self.on_distilled is not None:
+			self.on_distilled(self)
+		self.maybe_finish()
+
+	def note_failure(self, success, error):
+		if not success:
+			self.failed = True
+			self.error  = self.error or error
+
+	def maybe_finish(self):
+		with self.lock:
+			if self.finished or not self.distilled or self.pending:
+				return
+			self.finished = True
+
+		try:
+			if self.parked is not None:
+				if self.work_queue.park(self.queue_name, self.url, self.parked):
+					debug("Parked {0} for {1:.0f} seconds".format(self.url, self.parked))
+				else:
+					mention("Lost the lease on {0} before we could park it, someone else has it now".format(self.url))
+			elif self.failed:
+				retry_in = self.work_queue.fail(self.queue_name, self.url, self.error)
+				report_failure(self.queue_name, self.url, retry_in)
+			else:
+				self.work_queue.ack(self.queue_name, self.url, self.seq)
+		except Exception as e:
+			mention("Failed to settle {0}, it'll be retried when the lease expires: {1}".format(self.url, e))
+
+		if self.on_finished is not None:
+			self.on_finished(self)
+
+
+def report_failure(queue_name, url, retry_in):
+	if retry_in is None:
+		mention("Lost the lease on {0} before we could report failure, someone else has it now".format(url))
+	elif retry_in < 0:
+		mention("Giving up on {0}, it's been moved to the dead-letter set for {1}".format(url, queue_name))
+	else:
+		mention("Will retry {0} in {1:.0f} seconds".format(url, retry_in))
+
+
+class DocumentBuffer(object):
+	"""Accumulate documents and send them to ES with the bulk API.
+
+	Big backfills like provsysservers:// can yield thousands of documents,
+	it's a waste to spend a round trip to ES on every single one of them."""
+
+	def __init__(self, work_queue, max_docs=FLUSH_DOCS, max_age=FLUSH_SECONDS):
+		self.work_queue = work_queue
+		self.max_docs = max_docs
+		self.max_age  = max_age
+		self.entries  = []
+		self.oldest   = None
+
+	def __len__(self):
+		return len(self.entries)
+
+	def add(self, job, doc):
+		if not self.entries:
+			self.oldest = time.time()
+		self.entries.append( (job, doc) )
+
+		if self.should_flush():
+			self.flush()
+
+	def time_to_flush(self):
+		"How long until we're obliged to flush, None if there's nothing to flush"
+		if not self.entries:
+			return None
+		return max(0, self.oldest + self.max_age - time.time())
+
+	def should_flush(self):
+		if not self.entries:
+			return False
+		if len(self.entries) >= self.max_docs:
+			return True
+		return time.time() - self.oldest >= self.max_age
+
+	def flush(self):
+		if not self.entries:
+			return
+
+		(entries, self.entries, self.oldest) = (self.entries, [], None)
+		debug("Flushing {0} documents to the index".format(len(entries)))
+
+		try:
+			# Don't resurrect anything that's been deleted since we were
+			# asked to index it
+			tombstoned = self.work_queue.tombstoned([ (doc['url'], job.seq) for (job, doc) in entries ])
+			for ((job, doc), dead) in zip(entries, tombstoned):
+				if dead:
+					mention("Not indexing {0}, it's been deleted since {1} was enqueued".format(doc['url'], job.url))
+					job.doc_written(True)
+			entries = [ entry for (entry, dead) in zip(entries, tombstoned) if not dead ]
+			if not entries:
+				return
+
+			failures = bulk_add_to_index([ doc for (job, doc) in entries ])
+		except Exception as e:
+			# Something bigger than a bad document, like ES being unreachable
+			mention("Bulk indexing of {0} documents failed outright: {1}".format(len(entries), e))
+			for (job, doc) in entries:
+				job.doc_written(False, e)
+			return
+
+		failed_urls = {}
+		for (url, error) in failures:
+			failed_urls[url] = error
+			mention("Failed to add to index: {0}: {1}".format(url, error))
+
+		for (job, doc) in entries:
+			if doc['url'] in failed_urls:
+				job.doc_written(False, failed_urls[doc['url']])
+			else:
+				mention("Successfully added to index: %(url)s" % doc)
+				job.doc_written(True)
+
+
+
+def index(url, emit):
 	debug("URL to index: {0}".format(url))
 
 	try:
 		d = get_distiller(url)
+	except UpstreamUnavailable:
+		raise
 	except Exception as e:
 		raise RuntimeError("Don't know how to handle URL: {0}".format(url))
 
@@ -52,8 +306,7 @@ def index(url):
 			debug("400 chars of blob: {0}".format(trimmed_blob))
 		else: # unicode
 			debug(u"400 chars of blob: {0}".format(trimmed_blob).encode('utf8'))
-		add_to_index(doc)
-		mention("Successfully added to index: %(url)s" % doc)
+		emit(doc)
 		debug("")
 
 
@@ -63,59 +316,402 @@ def delete(url):
 		delete_from_index(url)
 	except Exception as e:
 		mention("Failed to delete {0} from index: {1}".format(url, e) )
+		raise
 	else:
 		mention("Deleted {0} from index".format(url) )
 
 
 
-def main(argv=None):
-	debug("Debug logging is enabled")
+def stop_gracefully(signum, frame):
+	global STOPPING
+	STOPPING = True
+	mention("Caught signal {0}, finishing up".format(signum))
+
+
+class FairScheduler(object):
+	"""Pick which doc_type's queue to claim from next, using smooth weighted
+	round-robin (as seen in nginx). A doc_type with weight 4 gets four turns
+	for every one that a doc_type with weight 1 gets, nicely interleaved
+	rather than all in a row."""
+
+	def __init__(self, weights=DOC_TYPE_WEIGHTS):
+		self.weights = weights
+		self.current = dict( (doc_type, 0) for doc_type in weights )
+
+	def pick(self, candidates):
+		if not candidates:
+			return None
+
+		total = 0
+		best  = None
+		for doc_type in candidates:
+			weight = self.weights.get(doc_type, 1)
+			self.current[doc_type] = self.current.get(doc_type, 0) + weight
+			total += weight
+			if best is None or self.current[doc_type] > self.current[best]:
+				best = doc_type
+
+		self.current[best] -= total
+		return best
+
+
+class Pipeline(object):
+	"""The stages of a worker, joined by bounded queues:
+
+	    claim (main thread)  ->  fetch+distil (FETCHERS threads)  ->  sink to ES (SINKS threads)
+
+	Each put() blocks when the next stage is full, which is how
+	backpressure propagates back up to the claimer. Meanwhile, fetchers
+	that are waiting on a slow upstream don't stop the sinks from writing
+	whatever documents are already distilled."""
+
+	def __init__(self, work_queue, fetchers=FETCHERS, sinks=SINKS, url_backlog=URL_BACKLOG, doc_backlog=DOC_BACKLOG):
+		self.work_queue  = work_queue
+		self.active      = dict( (doc_type, 0) for doc_type in DOC_TYPES )
+		self.active_lock = threading.Lock()
+		self.finished    = { 'done': 0, 'failed': 0, 'parked': 0 }
+		self.parked      = {}
+		self.urls        = Queue.Queue(maxsize=url_backlog)
+		self.docs        = Queue.Queue(maxsize=doc_backlog)
+		self.fetchers    = [ threading.Thread(target=self.fetch_loop, name="fetcher-{0}".format(i)) for i in range(fetchers) ]
+		self.sinks       = [ threading.Thread(target=self.sink_loop,  name="sink-{0}".format(i))    for i in range(sinks) ]
+
+	def start(self):
+		for thread in self.fetchers + self.sinks:
+			thread.daemon = True
+			thread.start()
+
+	def capacity(self, doc_type):
+		"""How many more URLs of this doc_type can we take on right now? The
+		limit is on URLs waiting for or being distilled, as that's what
+		loads up the upstream service; writing to ES doesn't count."""
+		with self.active_lock:
+			return DOC_TYPE_CONCURRENCY.get(doc_type, 1) - self.active.get(doc_type, 0)
+
+	def is_parked(self, doc_type):
+		"Is the upstream for this doc_type down? If so, leave its queue alone for now."
+		return self.parked.get(doc_type, 0) > time.time()
+
+	def park(self, doc_type, retry_in):
+		until = time.time() + retry_in
+		if until > self.parked.get(doc_type, 0):
+			self.parked[doc_type] = until
+
+	def job_distilled(self, job):
+		with self.active_lock:
+			self.active[job.doc_type] -= 1
+
+	def job_finished(self, job):
+		"Keep count of the URLs we've seen all the way through"
+		outcome = 'parked' if job.parked is not None else 'failed' if job.failed else 'done'
+		with self.active_lock:
+			self.finished[outcome] += 1
+
+	def claim(self, queue_name, url, seq, op):
+		"""Hand a URL to the fetchers, blocking while they're busy. Returns
+		False if we were told to stop while waiting."""
+		job = Job(self.work_queue, queue_name, url, seq, op, on_distilled=self.job_distilled, on_finished=self.job_finished)
+		with self.active_lock:
+			self.active[job.doc_type] = self.active.get(job.doc_type, 0) + 1
+
+		while not STOPPING:
+			try:
+				self.urls.put(job, timeout=1)
+				return True
+			except Queue.Full:
+				continue
+
+		self.job_distilled(job)
+		return False
+
+	def fetch_loop(self):
+		while True:
+			job = self.urls.get()
+			if job is None:
+				break
+
+			def emit(doc):
+				job.doc_emitted()
+				self.docs.put( (job, doc) )
+
+			try:
+				if job.op == DELETE_OP:
+					# The tombstone goes down first, so nothing can sneak
+					# in after the document is gone
+					self.work_queue.bury(job.url, job.seq)
+					delete(job.url)
+				else:
+					index(job.url, emit)
+			except UpstreamUnavailable as e:
+				mention("Parking {0}: {1}".format(job.url, e))
+				self.park(job.doc_type, e.retry_in)
+				job.park(e.retry_in)
+			except Exception as e:
+				mention("Something went boom while processing {0}: {1}".format(job.url, e))
+				job.distil_done(False, e)
+			else:
+				job.distil_done(True)
+
+	def sink_loop(self):
+		doc_buffer = DocumentBuffer(self.work_queue)
+		while True:
+			try:
+				entry = self.docs.get(timeout=doc_buffer.time_to_flush())
+			except Queue.Empty:
+				doc_buffer.flush()
+				continue
+
+			if entry is None:
+				break
+			doc_buffer.add(*entry)
+
+		doc_buffer.flush()
+
+	def stop(self):
+		"""Wind down the stages in order. If we're stopping because of a
+		signal then anything not yet fetched goes back on the queue,
+		otherwise the backlog is worked through first."""
+		if STOPPING:
+			unclaimed = {}
+			while True:
+				try:
+					job = self.urls.get_nowait()
+				except Queue.Empty:
+					break
+				unclaimed.setdefault(job.queue_name, []).append(job.url)
+			for queue_name in unclaimed:
+				self.work_queue.release(queue_name, unclaimed[queue_name])
+				mention("Returned {0} unprocessed URLs to {1}".format(len(unclaimed[queue_name]), queue_name))
+
+		for thread in self.fetchers:
+			self.urls.put(None)
+		for thread in self.fetchers:
+			thread.join()
+
+		for thread in self.sinks:
+			self.docs.put(None)
+		for thread in self.sinks:
+			thread.join()
+
+
+def run_worker(max_jobs=MAX_JOBS):
+	"""Process URLs until we're told to stop, or until we've claimed
+	max_jobs of them (if non-zero) and seen them through"""
 
 	redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
 	redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
 	teh_redis = redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0)
+	work_queue = UmadQueue(teh_redis, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY, retry_delay_limit=RETRY_DELAY_LIMIT, tombstone_seconds=TOMBSTONE_SECONDS)
 
-	while True:
+	signal.signal(signal.SIGTERM, stop_gracefully)
+	signal.signal(signal.SIGINT,  stop_gracefully)
+	socket.setdefaulttimeout(SOCKET_TIMEOUT)
+
+	pipeline = Pipeline(work_queue)
+	pipeline.start()
+	schedulers = { HIGH_PRIORITY: FairScheduler(), LOW_PRIORITY: FairScheduler() }
+	jobs_claimed = 0
+	last_reaped = 0
+	high_lane_streak = 0
+	just_woken = False
+
+	# Older listeners left a wakeup on the list for every URL they enqueued,
+	# and everything they enqueued in the old single queues
+	work_queue.forget_wakeups()
+	(drained, unroutable) = work_queue.drain_legacy_queues()
+	for queue_name in sorted(drained):
+		mention("Moved {0} URLs from the old queues into {1}".format(drained[queue_name], queue_name))
+	for url in unroutable:
+		mention("Dropped {0} from the old queues, nobody can handle it".format(url))
+
+	every_queue = all_queues()
+
+	def done_enough():
+		return STOPPING or (max_jobs and jobs_claimed >= max_jobs)
+
+	def claim_batch(queue_name, count):
+		"Lease some URLs and feed them to the pipeline, returning how many we handed over"
+		claims = work_queue.claim(queue_name, count)
+		handed_over = 0
+		while claims:
+			(url, enqueued, seq, op) = claims[0]
+			if not pipeline.claim(queue_name, url, seq, op):
+				break
+			claims.pop(0)
+			handed_over += 1
+
+		if claims:
+			work_queue.release(queue_name, [ url for (url, enqueued, seq, op) in claims ])
+			mention("Returned {0} unprocessed URLs to {1}".format(len(claims), queue_name))
+		return handed_over
+
+	while not done_enough():
 		try:
-			# Get URLs out of Redis. We're using this idiom to provide what is
-			# effectively a "BSPOP" (blocking pop from a set), on a sorted set.
-			# cf. Event Notification: http://redis.io/commands/blpop
+			# Anyone who's died holding a lease gets their URLs taken off them
+			if time.time() - last_reaped > REAP_INTERVAL:
+				last_reaped = time.time()
+				for queue_name in every_queue:
+					for (url, retry_in) in work_queue.reap(queue_name):
+						mention("Lease expired on {0}".format(url))
+						report_failure(queue_name, url, retry_in)
 
-			# Process deletions
-			while True:
-				pipeline = teh_redis.pipeline()
-				pipeline.zrange('umad_deletion_queue', 0, 0)
-				pipeline.zremrangebyrank('umad_deletion_queue', 0, 0)
-				(urls, urlcount) = pipeline.execute() # Should return:  [ [maybe_single_url], {0|1} ]
+				# Failed URLs get another go once they've waited long enough
+				for queue_name in every_queue:
+					for url in work_queue.promote(queue_name):
+						debug("Retrying {0}".format(url))
 
-				if not urls:
-					break
-				url = urls[0]
+				for doc_type in DOC_TYPES:
+					work_queue.exhume(doc_type)
 
-				try:                   delete(url)
-				except Exception as e: debug("Something went boom while deleting {0}: {1}".format(url, e))
+			depths = work_queue.depths(every_queue)
 
-			# Process additions/updates
-			while True:
-				pipeline = teh_redis.pipeline()
-				pipeline.zrange('umad_indexing_queue', 0, 0)
-				pipeline.zremrangebyrank('umad_indexing_queue', 0, 0)
-				(urls, urlcount) = pipeline.execute() # Should return:  [ [maybe_single_url], {0|1} ]
+			# Take turns at the queues that have work waiting, skipping
+			# doc_types whose upstream is down
+			waiting    = {}
+			candidates = {}
+			for lane in (HIGH_PRIORITY, LOW_PRIORITY):
+				waiting[lane]    = [ doc_type for doc_type in DOC_TYPES if depths[queue_for(INDEXING_QUEUE, doc_type, lane)] and not pipeline.is_parked(doc_type) ]
+				candidates[lane] = [ doc_type for doc_type in waiting[lane] if pipeline.capacity(doc_type) > 0 ]
 
-				if not urls:
-					break
-				url = urls[0]
+			lane = HIGH_PRIORITY
+			if not candidates[HIGH_PRIORITY] or (candidates[LOW_PRIORITY] and high_lane_streak >= LOW_LANE_EVERY - 1):
+				lane = LOW_PRIORITY
+
+			doc_type = schedulers[lane].pick(candidates[lane])
+			if doc_type is not None:
+				high_lane_streak = high_lane_streak + 1 if lane == HIGH_PRIORITY else 0
+				queue_name = queue_for(INDEXING_QUEUE, doc_type, lane)
+				count = min(BATCH_SIZE, pipeline.capacity(doc_type))
+				if max_jobs:
+					count = min(count, max_jobs - jobs_claimed)
+				handed_over = claim_batch(queue_name, count)
+				jobs_claimed += handed_over
 
-				try:                   index(url)
-				except Exception as e: debug("Something went boom while indexing {0}: {1}".format(url, e))
+				# There was only one wakeup for however much got enqueued. If
+				# there's more than we've just taken on, pass it along to
+				# another worker, one at a time rather than all at once.
+				if just_woken:
+					just_woken = False
+					if depths[queue_name] > handed_over or len(candidates[HIGH_PRIORITY] + candidates[LOW_PRIORITY]) > 1:
+						work_queue.wake()
+				continue
+
+			if done_enough():
+				continue
+
+			# There's work, but we're already as busy as we're allowed to be
+			if waiting[HIGH_PRIORITY] or waiting[LOW_PRIORITY]:
+				time.sleep(BUSY_WAIT_SECONDS)
+				continue
+
+			if just_woken:
+				# Someone else got to it first
+				just_woken = False
+				work_queue.spurious_wakeup()
 
 			debug("The barber is napping")
-			teh_redis.brpop('barber')
-			debug("------------------------")
-			debug("The barber was woken up!")
+			# Wake up in time for the reaper, even if nobody gives us a shove
+			latency = work_queue.nap(max(1, int(min(NAP_SECONDS, REAP_INTERVAL))))
+			if latency is not None:
+				just_woken = True
+				debug("------------------------")
+				debug("The barber was woken up! The wakeup was sent {0:.3f}sec ago".format(latency))
 		except Exception as e:
 			debug("Something went boom: {0}".format(e))
 
+	pipeline.stop()
+	# Anything claimed but not finished was put back on the queue
+	mention("Worker exiting after claiming {0} jobs: {done} done, {failed} failed, {parked} parked".format(jobs_claimed, **pipeline.finished))
+
+	return 0
+
+
+def supervise(num_processes=NUM_PROCESSES, max_jobs=MAX_JOBS):
+	"""Fork a pool of workers that all consume the same queues, respawning
+	them when they crash or retire. On SIGTERM we pass the signal along and
+	wait for everyone to finish their in-flight work."""
+
+	children = {}
+
+	def spawn():
+		pid = os.fork()
+		if pid == 0:
+			global PID_PREFIX
+			PID_PREFIX = '[pid {0}] '.format(os.getpid())
+			try:
+				rc = run_worker(max_jobs)
+			except:
+				import traceback
+				mention("Worker crashed: {0}".format(traceback.format_exc()))
+				rc = 1
+			os._exit(rc)
+
+		children[pid] = time.time()
+		mention("Started worker with pid {0}".format(pid))
+
+	def pass_it_on(signum, frame):
+		stop_gracefully(signum, frame)
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	signal.signal(signal.SIGTERM, pass_it_on)
+	signal.signal(signal.SIGINT,  pass_it_on)
+
+	mention("Supervising {0} workers, recycling after {1} jobs".format(num_processes, max_jobs or 'infinite'))
+
+	while True:
+		while not STOPPING and len(children) < num_processes:
+			spawn()
+
+		if not children:
+			break
+
+		try:
+			(pid, status) = os.wait()
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				continue
+			if e.errno == errno.ECHILD:
+				break
+			raise
+
+		started = children.pop(pid, None)
+		if started is None:
+			continue
+
+		if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+			mention("Worker {0} retired".format(pid))
+		else:
+			mention("Worker {0} died unexpectedly with status {1}".format(pid, status))
+			# Don't thrash if the children are falling over straight away
+			if time.time() - started < RESPAWN_DELAY:
+				time.sleep(RESPAWN_DELAY)
+
+	mention("All workers have finished, supervisor exiting")
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv
+
+	parser = OptionParser()
+	parser.add_option("--verbose", "-v",   dest="debug",     action="store_true", default=False,         help="Log exactly what's happening")
+	parser.add_option("--processes", "-n", dest="processes", type="int",          default=NUM_PROCESSES, help="Number of worker processes to supervise, [default: %default]")
+	parser.add_option("--max-jobs", "-m",  dest="max_jobs",  type="int",          default=MAX_JOBS,      help="Recycle each worker after this many URLs, 0 for never [default: %default]")
+	(options, args) = parser.parse_args(args=argv)
+
+	global DEBUG
+	DEBUG = DEBUG or options.debug
+	debug("Debug logging is enabled")
+
+	# A single worker doesn't need babysitting, daemontools will restart us
+	if options.processes <= 1:
+		return run_worker(options.max_jobs)
+
+	supervise(options.processes, options.max_jobs)
 
 	return 0
 
@@ -0,0 +1 @@
+../common/lucene_syntax.py
\ No newline at end of file
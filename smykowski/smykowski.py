@@ -6,6 +6,9 @@ import datetime
 import redis
 import json
 
+from umad_queue import UmadQueue, INDEX_OP, DELETE_OP
+from umad_routing import UnroutableURL
+
 
 # Smykowski takes the specifications from the customers and brings them down to
 # the software engineers.
@@ -28,14 +31,14 @@ DEBUG = os.environ.get('UMAD_SMYKOWSKI_DEBUG')
 PID_PREFIX = '[pid {0}] '.format(os.getpid())
 
 
-def enqueue(dst_redis, queue_name, url):
+def enqueue(work_queue, op, url):
 	try:
-		debug(u"About to insert {0} into {1}".format(url, queue_name))
-		pipeline = dst_redis.pipeline()
-		pipeline.zadd(queue_name, time.time(), url)
-		pipeline.lpush('barber', 'dummy_value')
-		pipeline.execute() # will return something like:   [ {0|1}, num_dummies ]
-		mention(u"Successful insertion of {0} into {1}".format(url, queue_name))
+		debug(u"About to insert {0} for {1}".format(url, op))
+		queue_name = work_queue.enqueue(url, op)
+		mention(u"Successful insertion of {0} into {1} for {2}".format(url, queue_name, op))
+	except UnroutableURL as e:
+		# Not everything that turns up in the logs is a document
+		debug(u"Not enqueueing {0}: {1}".format(url, e))
 	except Exception as e:
 		mention(u"Something went boom while inserting {0}: {1}".format(url, e))
 		raise
@@ -51,6 +54,7 @@ def main(argv=None):
 	redis_server_src_key = os.environ.get('UMAD_REDIS_AWESANT_KEY', 'umad_event:queue')
 	src_redis = redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=redis_server_db_src)
 	dst_redis = redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=redis_server_db_dst)
+	work_queue = UmadQueue(dst_redis)
 
 	# Get URLs out of Redis, look for interesting ones, put them into the
 	# indexing listener's queue. Make this very stupid, daemontools will
@@ -85,7 +89,7 @@ def main(argv=None):
 			# from the real ones, we use INDEX as the method
 			# instesd.
 			if request_method in ('INDEX',):
-				enqueue(dst_redis, 'umad_indexing_queue', request_url)
+				enqueue(work_queue, INDEX_OP, request_url)
 
 		else:
 			# nginx encodes URLs with backslash hex escapes, which
@@ -99,10 +103,10 @@ def main(argv=None):
 			# http://stackoverflow.com/a/4020824
 
 			if request_method in ('POST', 'PUT'):
-				enqueue(dst_redis, 'umad_indexing_queue', request_url)
+				enqueue(work_queue, INDEX_OP, request_url)
 
 			if request_method in ('DELETE',):
-				enqueue(dst_redis, 'umad_deletion_queue', request_url)
+				enqueue(work_queue, DELETE_OP, request_url)
 
 		# Make a note that we saw a heartbeat. We'd like to keep all
 		# the hits we've seen in the last N minutes (eg. 5min), but
@@ -1,20 +1,43 @@
 #!/usr/bin/env python
 
 import sys
+import time
 import argparse
+import urlparse
 import requests
 
 parser = argparse.ArgumentParser(description="Read URLs from stdin or files, and enqueue them for indexing/deletion")
 parser.add_argument('input', type=argparse.FileType('r'), default=[sys.stdin], nargs='*', metavar="filename", help="Input file/s, defaults to stdin (-)")
 parser.add_argument('-d', '--delete', action="store_true", help="Enqueue URLs for deletion instead of re/indexing")
 parser.add_argument('--listener', default='https://umad-indexer.anchor.net.au/', help="URL of the UMAD listener [default: %(default)s]")
+parser.add_argument('-p', '--priority', default='low', choices=['low', 'high'], help="Queue priority, use high for things that people are waiting on [default: %(default)s]")
+parser.add_argument('-c', '--chunk-size', type=int, default=1000, help="Send this many URLs to the listener per request [default: %(default)s]")
 args = parser.parse_args()
 
-request_method = requests.delete if args.delete else requests.get
+bulk_url = urlparse.urljoin(args.listener, 'bulk')
+action   = 'delete' if args.delete else 'index'
 
+def send(urls):
+	while True:
+		r = requests.post(bulk_url, params={'action':action, 'priority':args.priority}, data='\n'.join(urls), headers={'Content-Type':'text/plain; charset=utf-8'}, verify=False)
+		if r.status_code != 429:
+			break
+		# The indexers are behind, give them a chance to catch up
+		retry_after = int(r.headers.get('Retry-After', 60))
+		sys.stderr.write("Listener is busy, trying again in {0} seconds\n".format(retry_after))
+		time.sleep(retry_after)
+	print r.text
+	r.raise_for_status()
+
+chunk = []
 for fh in args.input:
 	for URL in fh.readlines():
 		URL = URL.strip()
 		if URL:
-			r = request_method(args.listener, params={'url':URL.strip()}, verify=False)
-			print r.text
+			chunk.append(URL)
+		if len(chunk) >= args.chunk_size:
+			send(chunk)
+			chunk = []
+
+if chunk:
+	send(chunk)
@@ -0,0 +1 @@
+common/umad_queue.py
\ No newline at end of file
@@ -0,0 +1 @@
+common/umad_routing.py
\ No newline at end of file
@@ -1,15 +1,27 @@
 import sys
 import os
+import time
+import urlparse
 import requests
 from distil.domain import DomainDistiller
 
 UMAD_INDEXER_URL = os.environ.get('UMAD_INDEXER_URL', 'https://umad-indexer.anchor.net.au/')
+# How many URLs to send to the listener at a time
+CHUNK_SIZE = 1000
 
 def main():
 	distiller = DomainDistiller(None)
 	domain_list = distiller.get_domain_list()
-	for domain in domain_list:
-		r = requests.get(UMAD_INDEXER_URL, params={'url':'https://domains.anchor.com.au/{0}'.format(domain)}, verify=False)
+	urls = [ 'https://domains.anchor.com.au/{0}'.format(domain) for domain in domain_list ]
+
+	for i in range(0, len(urls), CHUNK_SIZE):
+		# This is a bulk backfill, don't get in the way of interactive updates
+		while True:
+			r = requests.post(urlparse.urljoin(UMAD_INDEXER_URL, 'bulk'), params={'action':'index', 'priority':'low'}, data='\n'.join(urls[i:i+CHUNK_SIZE]), verify=False)
+			if r.status_code != 429:
+				break
+			# The indexers are behind, wait until the listener is ready for more
+			time.sleep(int(r.headers.get('Retry-After', 60)))
 		print r.text
 
 if __name__ == "__main__":
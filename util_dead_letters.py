@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+'''List and replay the URLs that the indexing worker has given up on.
+
+Like so:
+	python util_dead_letters.py list
+	python util_dead_letters.py replay
+	python util_dead_letters.py replay https://docs.anchor.net.au/some/page
+'''
+
+import sys
+import os
+import time
+import argparse
+
+import redis
+
+from umad_queue import UmadQueue, all_queues
+
+
+parser = argparse.ArgumentParser(description="List and replay dead-lettered URLs")
+parser.add_argument('action', choices=['list', 'replay'], help="What to do with the dead letters")
+parser.add_argument('urls', nargs='*', metavar="URL", help="Only replay these URLs [default: all of them]")
+args = parser.parse_args()
+
+redis_server_host = os.environ.get('UMAD_REDIS_HOST', 'localhost')
+redis_server_port = os.environ.get('UMAD_REDIS_PORT', 6379)
+teh_redis = redis.StrictRedis(host=redis_server_host, port=int(redis_server_port), db=0)
+work_queue = UmadQueue(teh_redis)
+
+for queue_name in all_queues():
+	if args.action == 'list':
+		for (url, died, error) in work_queue.dead_letters(queue_name):
+			print "{0}\t{1}\t{2}\t{3}".format(queue_name, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(died)), url, error)
+	else:
+		replayed = work_queue.replay(queue_name, args.urls or None)
+		print "Replayed {0} URLs into {1}".format(replayed, queue_name)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''Install the index templates from common/index_templates.py into ES, so that
+new umad_* indices get our mappings. Run it when setting up a new cluster, and
+after bumping INDEX_TEMPLATE_VERSION.
+
+Templates only apply to indices created after they're installed. Existing
+indices are listed with the version of the mapping they were created with, and
+any that are out of date need deleting and reindexing.
+
+When an index doesn't exist, we also forget the worker's fingerprints for its
+doc_type. Otherwise the worker would skip every document it thinks it's
+already written, and a rebuilt index would stay empty until they expired.
+
+Like so:
+	python util_install_index_templates.py
+	python util_install_index_templates.py --check
+	python util_install_index_templates.py --create-indices rt customer
+'''
+
+import sys
+import argparse
+
+import elasticsearch
+
+from elasticsearch_backend import es, indices, fingerprint_cache, search_cache, KNOWN_DOC_TYPES
+from index_templates import index_template, template_version, INDEX_TEMPLATE_VERSION, DOC_TYPE_FIELDS
+
+
+parser = argparse.ArgumentParser(description="Install index templates for the umad_* indices")
+parser.add_argument('doc_types', nargs='*', metavar="DOC_TYPE", help="Only install templates for these doc_types [default: all of them]")
+parser.add_argument('-n', '--check', action="store_true", help="Report what's installed, but don't change anything")
+parser.add_argument('-f', '--force', action="store_true", help="Install the templates even if a newer version is already there")
+parser.add_argument('--create-indices', action="store_true", help="Also create indices that don't exist yet, so they get the mapping straight away")
+args = parser.parse_args()
+
+unknown = set(args.doc_types) - KNOWN_DOC_TYPES
+if unknown:
+	parser.error("We don't know about these doc_types: {0}".format(', '.join(sorted(unknown))))
+
+# A new distiller needs a mapping before its documents can be indexed
+unmapped = KNOWN_DOC_TYPES - set(DOC_TYPE_FIELDS)
+if unmapped:
+	sys.stderr.write("These doc_types have no mapping in index_templates.py: {0}\n".format(', '.join(sorted(unmapped))))
+	sys.exit(1)
+
+
+def installed_version(doc_type):
+	"The version of the template in ES, None if it's not there or not one of ours"
+	name = "umad_{0}".format(doc_type)
+	try:
+		templates = indices.get_template(name=name)
+	except elasticsearch.NotFoundError:
+		return None
+	mappings = templates.get(name, {}).get('mappings', {})
+	return template_version(mappings.get(doc_type, {}))
+
+
+def index_version(doc_type):
+	"The version of the mapping the index was created with, or 'missing'"
+	index_name = "umad_{0}".format(doc_type)
+	try:
+		mappings = indices.get_mapping(index=index_name, doc_type=doc_type)
+	except elasticsearch.NotFoundError:
+		return 'missing'
+	mapping = mappings.get(index_name, {}).get('mappings', {}).get(doc_type, {})
+	return template_version(mapping)
+
+
+out_of_date = []
+for doc_type in sorted(args.doc_types or KNOWN_DOC_TYPES):
+	name = "umad_{0}".format(doc_type)
+	current = installed_version(doc_type)
+
+	if args.check:
+		action = "template v{0}".format(current) if current else "no template"
+	elif current is not None and current > INDEX_TEMPLATE_VERSION and not args.force:
+		action = "template v{0} is newer than ours, left alone (use --force)".format(current)
+	elif current == INDEX_TEMPLATE_VERSION and not args.force:
+		action = "template v{0} already installed".format(current)
+	else:
+		indices.put_template(name=name, body=index_template(doc_type))
+		action = "installed template v{0}".format(INDEX_TEMPLATE_VERSION)
+
+	existing = index_version(doc_type)
+	if existing == 'missing' and not args.check:
+		fingerprint_cache().forget_all(doc_type)
+		search_cache().invalidate([doc_type])
+		action += ", forgot fingerprints"
+		if args.create_indices:
+			indices.create(index=name)
+			existing = index_version(doc_type)
+			action += ", created index"
+
+	if existing == 'missing':
+		index_state = "no index yet"
+	elif existing == INDEX_TEMPLATE_VERSION:
+		index_state = "index is up to date"
+	else:
+		index_state = "index has {0}, needs reindexing".format("v{0}".format(existing) if existing else "a dynamic mapping")
+		out_of_date.append(name)
+
+	print "{0}: {1}, {2}".format(name, action, index_state)
+
+if out_of_date:
+	print
+	print "These indices were created with an old mapping: {0}".format(', '.join(out_of_date))
+	print "To rebuild them, delete them with  curl -XDELETE <es-node>/<index>  then run"
+	print "  python util_install_index_templates.py --create-indices {0}".format(' '.join( name.split('_', 1)[1] for name in out_of_date ))
+	print "to create them afresh and forget the worker's fingerprints, and re-enqueue their URLs."
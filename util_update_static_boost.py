@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''Bring the static_boost of indexed documents up to date after changing
+STATIC_BOOST_RULES in elasticsearch_backend. Only the documents whose boost
+has changed are touched, with partial updates, so nothing gets redistilled.
+
+Like so:
+	python util_update_static_boost.py
+	python util_update_static_boost.py --dry-run rt map
+'''
+
+import sys
+import argparse
+
+import elasticsearch
+import elasticsearch.helpers
+
+from elasticsearch_backend import es, static_boost, search_cache, KNOWN_DOC_TYPES, STATIC_BOOST_RULES
+
+
+parser = argparse.ArgumentParser(description="Recompute static_boost for documents that are already indexed")
+parser.add_argument('doc_types', nargs='*', metavar="DOC_TYPE", help="Only update these doc_types [default: all of them]")
+parser.add_argument('-n', '--dry-run', action="store_true", help="Count what would change, but don't change it")
+parser.add_argument('--chunk-size', type=int, default=500, help="Send this many updates to ES at a time [default: %(default)s]")
+args = parser.parse_args()
+
+unknown = set(args.doc_types) - KNOWN_DOC_TYPES
+if unknown:
+	parser.error("We don't know about these doc_types: {0}".format(', '.join(sorted(unknown))))
+
+# We only need the fields that the rules look at
+fields = sorted(set( field for (field, test, value, boost) in STATIC_BOOST_RULES ) | set(['url', 'doc_type', 'static_boost']))
+
+
+def changed_boosts(index_name, counts):
+	"Yield a partial update for every document whose static_boost is out of date"
+	for hit in elasticsearch.helpers.scan(es, index=index_name, query={ "query": { "match_all": {} }, "_source": fields }):
+		counts['seen'] += 1
+		document = dict(hit.get('_source', {}))
+		document.setdefault('doc_type', hit['_type'])
+		document.setdefault('url', hit['_id'])
+
+		boost = static_boost(document)
+		if document.get('static_boost') == boost:
+			continue
+
+		counts['changed'] += 1
+		yield {
+			'_op_type': 'update',
+			'_index':   index_name,
+			'_type':    hit['_type'],
+			'_id':      hit['_id'],
+			'doc':      { 'static_boost': boost },
+		}
+
+
+for doc_type in sorted(args.doc_types or KNOWN_DOC_TYPES):
+	index_name = "umad_{0}".format(doc_type)
+	counts = { 'seen': 0, 'changed': 0 }
+
+	try:
+		if args.dry_run:
+			for update in changed_boosts(index_name, counts):
+				pass
+			errors = []
+		else:
+			(updated, errors) = elasticsearch.helpers.bulk(es, changed_boosts(index_name, counts), chunk_size=args.chunk_size, raise_on_error=False)
+	except elasticsearch.NotFoundError as e:
+		print "{0}: no index yet, skipping".format(index_name)
+		continue
+
+	for error in errors:
+		item = error.get('update', error)
+		sys.stderr.write("Couldn't update {0}: {1}\n".format(item.get('_id'), item.get('error', item)))
+
+	if counts['changed'] and not args.dry_run:
+		# Cached results are in the old order
+		search_cache().invalidate([doc_type])
+
+	print "{0}: {1} documents, {2} with a new static_boost{3}, {4} failed".format(index_name, counts['seen'], counts['changed'], " (dry run)" if args.dry_run else "", len(errors))
@@ -3,7 +3,6 @@ import sys
 import os
 import re
 import cStringIO
-import cgi
 from optparse import OptionParser
 from operator import itemgetter
 
@@ -12,7 +11,9 @@ from bottle import route, request, response, template, static_file, run, view, d
 from dateutil.parser import *
 from dateutil.tz import *
 
+import elasticsearch
 from elasticsearch_backend import *
+from search_query import parse_query, InvalidQuery
 
 
 DEBUG = False
@@ -71,34 +72,39 @@ def search(search_term, count):
 	template_dict['version_string']   = VERSION_STRING
 	template_dict['umad_indexer_url'] = UMAD_INDEXER_URL
 
-	# ES is case insensitive, but our query mangling below isn't.  Lets just lowercase it all now before searching
-	search_term = template_dict['search_term'].lower()
-
-	first_word = search_term.split(':')[0]
-	# Some people use synonyms for the doctypes
-	aliases = {
-		'domains': 'domain',
-		'customers': 'customer',
-		'wiki': 'map',
-		'server': 'provsys',
-	}
-	if first_word in aliases:
-		search_term = search_term.replace(first_word, aliases[first_word])
-		first_word = aliases[first_word]
-
-	# If the query is prefixed with doctype:, then only return results of _type:doctype
-	# eg: customer: Anchor
-	if first_word in KNOWN_DOC_TYPES:
-		search_term = '_type:' + search_term.replace(':', ' ', 1)
-
-	# Pre-query validity check
-	template_dict['valid_search_query'] = valid_search_query(search_term)
+	# Nothing to search for, eg. the front page
+	if not search_term.strip():
+		return template_dict
+
+	# Pull out the doc_type and any other restrictions, eg.
+	# "rt: status:open customer:anchor disk" only searches the RT index, for
+	# open tickets with Anchor as the customer that mention disks. There's no
+	# point asking the other indices, they won't have anything.
+	try:
+		parsed = parse_query(template_dict['search_term'], KNOWN_DOC_TYPES)
+	except InvalidQuery as e:
+		debug(u"Invalid search query: {0}".format(e).encode('utf8'))
+		template_dict['valid_search_query'] = False
+		return template_dict
+
+	# Pre-query validity check. A doc_type or filters on their own are fine,
+	# that's everything they match.
+	if parsed.text.strip():
+		template_dict['valid_search_query'] = valid_search_query(parsed.text)
 	if not template_dict['valid_search_query']:
 		# Bail out early
 		return template_dict
 
 	# Search nao
-	results = search_index(search_term, max_hits=template_dict['count'])
+	try:
+		results = search_index(parsed.text, max_hits=template_dict['count'], doc_types=parsed.doc_types, filters=parsed.filters)
+	except elasticsearch.TransportError as e:
+		# The pre-query check can't catch everything
+		if not is_query_error(e.error):
+			raise
+		debug(u"Invalid search query according to ES: {0}".format(e.error).encode('utf8'))
+		template_dict['valid_search_query'] = False
+		return template_dict
 	result_docs = results['hits']
 	template_dict['hit_limit'] = results['hit_limit']
 
@@ -113,7 +119,7 @@ def search(search_term, count):
 		#     id		str
 		#     score		number
 		#     type		str
-		#     blob		str
+		#     extract		str
 		#     other_metadata	dict
 		#     highlight		dict
 
@@ -127,25 +133,9 @@ def search(search_term, count):
 		hit['id'] = doc['id']
 		hit['score'] = "{0:.2f}".format(doc['score'])
 
-		# ES always returns a highlight dict now, though it may be empty.
-		# Test for presence of blob and excerpt, and use them.
-		#
-		# I've mixed feelings on how to present the highlight fragments. Google
-		# appears to present just one. We always get a list of highlights (up to 5),
-		# and could provide a couple of fragments like so:
-		#
-		#     extract = '&hellip;<br/>'.join(highlights)
-		#
-		# But, it's difficult to identify the breaks visually so I'm sticking
-		# with 1st-fragment for now.
-		if doc['highlight'].get('excerpt'): # None (False) if not present, or empty list (False), or populated list (True)
-			hit['extract'] = doc['highlight'].get('excerpt')[0]
-		# There was no highlighted matches, so show the excerpt if we have it
-		elif 'excerpt' in doc['other_metadata']:
-			hit['extract'] = cgi.escape(doc['other_metadata']['excerpt'][:200])
-		# And if that doesn't exist either, show the blob
-		else:
-			hit['extract'] = cgi.escape(doc['blob'][:200])
+		# The backend picks out the highlighted bit of the excerpt or blob,
+		# already escaped, see build_extract()
+		hit['extract'] = doc['extract']
 
 		if 'last_updated' in doc['other_metadata'] and doc['other_metadata']['last_updated'] is not None:
 			pretty_last_updated = parse(doc['other_metadata']['last_updated']).astimezone(tzlocal()).strftime('%Y-%m-%d %H:%M')
@@ -0,0 +1 @@
+../common/search_query.py
\ No newline at end of file